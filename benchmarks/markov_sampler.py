@@ -0,0 +1,85 @@
+"""compares /markov sentence generation speed, old lil_matrix loop vs chain.Sampler
+
+usage: python benchmarks/markov_sampler.py [states] [sentences]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+from numpy.random import choice
+from scipy.sparse import coo_matrix, find
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from chain import Transitions  # noqa: E402
+
+MIN_OUTPUT_STATES = 4
+MAX_OUTPUT_STATES = 50
+
+
+# random chain with zipf distributed words and ~1/8 chance of ending a sentence after each word
+def build(states, edges):
+    rng = np.random.default_rng(0)
+    src = rng.integers(0, states, edges)
+    dst = np.minimum(rng.zipf(1.3, edges), states - 1)
+    dst[rng.random(edges) < 1 / 8] = 0
+    dst[src == 0] = np.maximum(dst[src == 0], 1)
+    return coo_matrix((np.ones(edges, dtype=np.int64), (src, dst)), shape=(states, states)).tocsr()
+
+
+# the generation loop as it was before chain.Sampler
+def legacy(transitions):
+    output = []
+    state_index = 0
+
+    while (state_index != 0 or len(output) == 0) and len(output) < MAX_OUTPUT_STATES:
+        branches, probabilities = find(transitions.getrow(state_index))[1:]
+
+        if len(branches) > 1 and branches[0] == 0 and len(output) < MIN_OUTPUT_STATES:
+            branches = branches[1:]
+            probabilities = probabilities[1:]
+
+        transition_sum = sum(probabilities)
+        probabilities = tuple(i/transition_sum for i in probabilities)
+
+        state_index = choice(branches, p=probabilities)
+
+        if state_index != 0:
+            output.append(state_index)
+
+    return output
+
+
+def sampled(sampler):
+    return sampler.walk(0, 0, MIN_OUTPUT_STATES, MAX_OUTPUT_STATES)
+
+
+def rate(fn, arg, count):
+    start = time.perf_counter()
+    tokens = sum(len(fn(arg)) for _ in range(count))
+    elapsed = time.perf_counter() - start
+    return count / elapsed, tokens / count
+
+
+def main():
+    states = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    csr = build(states, states * 8)
+
+    build_start = time.perf_counter()
+    sampler = Transitions(csr).sampler
+    build_time = time.perf_counter() - build_start
+
+    old, old_len = rate(legacy, csr.tolil(), count)
+    new, new_len = rate(sampled, sampler, count * 20)
+
+    print('{} states, {} transitions'.format(states, csr.nnz))
+    print('sampler build: {:.1f} ms'.format(build_time * 1000))
+    print('legacy loop:   {:10.1f} sentences/sec ({:.1f} states avg)'.format(old, old_len))
+    print('sampler:       {:10.1f} sentences/sec ({:.1f} states avg)'.format(new, new_len))
+    print('speedup:       {:10.1f}x'.format(new / old))
+
+
+if __name__ == '__main__':
+    main()
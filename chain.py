@@ -0,0 +1,485 @@
+import os
+import pickle
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from random import randrange
+
+import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix
+
+
+_SHARED = {}  # csr arrays handed to each reachability pool worker when it starts
+
+# binary model layout: header, then token offsets, utf-8 token table, indptr, indices and counts,
+# each array starting on an 8 byte boundary so it can be memory-mapped in place
+MAGIC = b'YMKV'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sIQQQQI')  # magic, version, serial, states, transitions, token table bytes, index itemsize
+
+
+class Vocabulary:
+    """bidirectional token <-> state id mapping, id 0 is always the absorbing state"""
+
+    def __init__(self, tokens=(' ',)):
+        self._tokens = list(tokens)  # id-ordered token array
+        self._ids = {t: i for i, t in enumerate(self._tokens)}
+
+        if len(self._ids) != len(self._tokens):
+            raise ValueError('Duplicate tokens in vocabulary.')
+
+        self.mark = len(self._tokens)  # states already persisted, later ones go in the next delta
+        self.restructured = False  # ids changed since the last snapshot, deltas can't describe that
+
+    @staticmethod
+    def load(states):
+        # MARKOV.pkl used to store STATES as a plain list
+        return states if isinstance(states, Vocabulary) else Vocabulary(states)
+
+    @property
+    def dirty(self):
+        return self.restructured or len(self._tokens) > self.mark
+
+    def additions(self):
+        """(id of the first new state, new states) since the last persist"""
+        return self.mark, self._tokens[self.mark:]
+
+    def persisted(self):
+        self.mark = len(self._tokens)
+        self.restructured = False
+
+    def index(self, token):
+        return self._ids[token]
+
+    def get(self, token, default=None):
+        return self._ids.get(token, default)
+
+    def add(self, token):
+        """adds token if missing, returns its id"""
+        i = self._ids.get(token)
+        if i is None:
+            i = len(self._tokens)
+            self._ids[token] = i
+            self._tokens.append(token)
+        return i
+
+    def extend(self, tokens):
+        return [self.add(t) for t in tokens]
+
+    def delete(self, token):
+        """removes token and compacts ids above it, returns removed id"""
+        i = self._ids.pop(token)
+        del self._tokens[i]
+        for j in range(i, len(self._tokens)):
+            self._ids[self._tokens[j]] = j
+        self.restructured = True
+        return i
+
+    def merge(self, source, target):
+        """removes source, returns (removed id, id of target after compaction)"""
+        if source == target:
+            raise ValueError('Cannot merge a state into itself.')
+        if target not in self._ids:
+            raise KeyError(target)
+        i = self.delete(source)
+        return i, self._ids[target]
+
+    def rename(self, old, new):
+        if new in self._ids:
+            raise ValueError('State "{}" already exists.'.format(new))
+        i = self._ids.pop(old)
+        self._tokens[i] = new
+        self._ids[new] = i
+        self.restructured = True
+        return i
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def __iter__(self):
+        return iter(self._tokens)
+
+    def __contains__(self, token):
+        return token in self._ids
+
+    def __getitem__(self, i):
+        return self._tokens[i]
+
+    def __getstate__(self):
+        return self._tokens
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    def __repr__(self):
+        return 'Vocabulary ({} states)'.format(len(self._tokens))
+
+
+class Transitions:
+    """sparse transition counts, increments are buffered in a dict of counts and folded into csr when read"""
+
+    COMPACT_SIZE = 4096  # pending (src, dst) pairs that force a compaction
+
+    def __init__(self, matrix=None):
+        self._csr = csr_matrix((1, 1), dtype=np.int64) if matrix is None else csr_matrix(matrix, dtype=np.int64)
+        self._size = self._csr.shape[0]
+        self._pending = {}
+        self._journal = {}  # increments since the last persist
+        self.restructured = False
+        self._cache = {}
+        self._cache_version = 0
+        self.version = 0  # bumped on every change, lets readers cache derived structures
+
+    @staticmethod
+    def load(matrix):
+        # MARKOV.pkl used to store TRANSITIONS as a lil_matrix
+        return matrix if isinstance(matrix, Transitions) else Transitions(matrix)
+
+    @property
+    def shape(self):
+        return self._size, self._size
+
+    @property
+    def csr(self):
+        self.compact()
+        return self._csr
+
+    @property
+    def sampler(self):
+        """sampler over the current counts, rebuilt lazily after ingestion"""
+        return self._cached('sampler', lambda csr: Sampler(csr, self.version))
+
+    @property
+    def degrees(self):
+        """number of branches per state"""
+        return self._cached('degrees', lambda csr: np.diff(csr.indptr))
+
+    @property
+    def popularity(self):
+        """total incoming transition counts per state"""
+        return self._cached('popularity', lambda csr: np.bincount(csr.indices, weights=csr.data, minlength=self._size))
+
+    def _cached(self, key, build):
+        if self._cache_version != self.version:
+            self._cache, self._cache_version = {}, self.version
+
+        if key not in self._cache:
+            self._cache[key] = build(self.csr)
+        return self._cache[key]
+
+    def resize(self, size):
+        # the csr arrays are only padded at the next compaction
+        if size > self._size:
+            self._size = size
+            self.version += 1
+
+    @property
+    def dirty(self):
+        return self.restructured or bool(self._journal)
+
+    def journal(self):
+        """(src, dst) pairs and counts incremented since the last call or persist"""
+        journal, self._journal = self._journal, {}
+        pairs = np.array(list(journal.keys()), dtype=np.int64).reshape(-1, 2)
+        return pairs, np.fromiter(journal.values(), dtype=np.int64, count=len(journal))
+
+    def persisted(self):
+        self._journal = {}
+        self.restructured = False
+
+    def increment(self, src, dst, n=1):
+        key = (src, dst)
+        self._pending[key] = self._pending.get(key, 0) + n
+        self._journal[key] = self._journal.get(key, 0) + n
+        self.version += 1
+
+        if len(self._pending) >= self.COMPACT_SIZE:
+            self.compact()
+
+    def update(self, counts):
+        """bulk increment from a mapping of (src, dst) -> count"""
+        for key, n in counts.items():
+            self._pending[key] = self._pending.get(key, 0) + n
+            self._journal[key] = self._journal.get(key, 0) + n
+        self.version += 1
+
+        if len(self._pending) >= self.COMPACT_SIZE:
+            self.compact()
+
+    def compact(self):
+        # a new matrix sharing data and indices, readers holding the old one never see it change
+        if self._csr.shape[0] != self._size:
+            indptr = np.pad(self._csr.indptr, (0, self._size - self._csr.shape[0]), mode='edge')
+            self._csr = csr_matrix((self._csr.data, self._csr.indices, indptr), shape=self.shape)
+
+        if self._pending:
+            pairs = np.array(list(self._pending.keys()), dtype=np.int64)
+            counts = np.fromiter(self._pending.values(), dtype=np.int64, count=len(self._pending))
+            delta = coo_matrix((counts, (pairs[:, 0], pairs[:, 1])), shape=self.shape).tocsr()
+
+            self._csr = self._csr + delta
+            self._pending = {}
+
+    def delete(self, i):
+        """drops state i and compacts the ids above it"""
+        mapping = self._shifted(i)
+        mapping[i] = -1
+        self._remap(mapping)
+
+    def merge(self, i, target):
+        """folds state i into target, target being its id after compaction"""
+        mapping = self._shifted(i)
+        mapping[i] = target
+        self._remap(mapping)
+
+    def _shifted(self, i):
+        ids = np.arange(self._size, dtype=np.int64)
+        return ids - (ids > i)
+
+    def _remap(self, mapping):
+        coo = self.csr.tocoo()
+        rows, cols = mapping[coo.row], mapping[coo.col]
+        keep = (rows >= 0) & (cols >= 0)
+
+        self._size -= 1
+        # duplicate (row, col) pairs created by a merge are summed by tocsr
+        self._csr = coo_matrix((coo.data[keep], (rows[keep], cols[keep])), shape=self.shape).tocsr()
+        self.restructured = True
+        self.version += 1
+
+    def __repr__(self):
+        return 'Transitions {}x{} ({} pending)'.format(self._size, self._size, len(self._pending))
+
+
+class Sampler:
+    """frozen csr arrays plus cumulative weights, each step is a single searchsorted over one row"""
+
+    def __init__(self, csr, version=0):
+        csr.sort_indices()  # keeps the absorbing state first in every row it appears in
+        self.indptr = csr.indptr
+        self.indices = csr.indices
+        self.cumulative = np.concatenate(([0], np.cumsum(csr.data, dtype=np.int64)))
+        self.version = version
+
+    def step(self, state, skip_end=False):
+        start, end = int(self.indptr[state]), int(self.indptr[state + 1])
+
+        if start == end:
+            return 0
+
+        # skipping the end state is just an offset into the row
+        if skip_end and end - start > 1 and self.indices[start] == 0:
+            start += 1
+
+        draw = randrange(int(self.cumulative[start]), int(self.cumulative[end]))
+        return int(self.indices[start + np.searchsorted(self.cumulative[start + 1:end + 1], draw, side='right')])
+
+    def walk(self, state=0, length=0, min_length=0, max_length=50):
+        """walks from state until the absorbing state, length counts states already in the output"""
+        states = []
+
+        while length < max_length:
+            state = self.step(state, length < min_length)
+            if state == 0:
+                break
+
+            states.append(state)
+            length += 1
+
+        return states
+
+    def walks(self, count, state=0, length=0, min_length=0, max_length=50):
+        """advances count independent walks from state at once, same rules as walk"""
+        states = np.full(count, state, dtype=np.int64)
+        paths = np.zeros((count, max(max_length - length, 0)), dtype=np.int64)
+        live = np.arange(count)
+
+        if not len(self.indices):
+            return [[] for _ in range(count)]
+
+        for step in range(paths.shape[1]):
+            rows = states[live]
+            start, end = self.indptr[rows].astype(np.int64), self.indptr[rows + 1].astype(np.int64)
+            empty = start == end
+
+            if length + step < min_length:
+                first = self.indices[np.minimum(start, len(self.indices) - 1)]
+                start += (end - start > 1) & (first == 0)
+
+            low, high = self.cumulative[start], self.cumulative[end]
+            draw = np.minimum(low + (np.random.random(len(live)) * (high - low)).astype(np.int64), high - 1)
+            # draws stay inside their row's range, so one search over the whole array finds the branch
+            picks = np.searchsorted(self.cumulative, draw, side='right') - 1
+            chosen = np.where(empty, 0, self.indices[np.clip(picks, 0, len(self.indices) - 1)])
+
+            paths[live, step] = chosen
+            states[live] = chosen
+            live = live[chosen != 0]
+
+            if not len(live):
+                break
+
+        # ids are only 0 after a walk has ended
+        return [[int(i) for i in p[p != 0]] for p in paths]
+
+
+def frontiers(indptr, indices, start, steps):
+    """yields the states reachable in exactly 1, 2, ... steps steps from start, touching only their edges"""
+    frontier = np.array([start], dtype=np.int64)
+
+    for _ in range(steps):
+        starts = indptr[frontier].astype(np.int64)
+        lengths = indptr[frontier + 1] - starts
+        total = int(lengths.sum())
+
+        # positions of every edge leaving the frontier, gathered as one flat index
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        frontier = np.unique(indices[offsets + np.arange(total)])
+        yield frontier
+
+
+def reach(indptr, indices, state, steps):
+    """(states reachable after steps steps, first step with more than one branch or -1, branches at that step)"""
+    converge, diverge, branches = int(steps == 0), -1, 0
+
+    for s, frontier in enumerate(frontiers(indptr, indices, state, steps + 1)):
+        if diverge < 0 and len(frontier) > 1:
+            diverge, branches = s, len(frontier)
+        if s == steps - 1:
+            converge = len(frontier)
+
+    return converge, diverge, branches
+
+
+def _share(indptr, indices):
+    _SHARED['indptr'], _SHARED['indices'] = indptr, indices
+
+
+def _reach_chunk(states, steps):
+    return [reach(_SHARED['indptr'], _SHARED['indices'], s, steps) for s in states]
+
+
+def reachability(csr, steps, workers=None, chunk=512):
+    """reach() for every state, split across a pool of worker processes"""
+    size = csr.shape[0]
+    chunks = [range(i, min(i + chunk, size)) for i in range(0, size, chunk)]
+
+    # forkserver, forking the threaded bot could leave workers stuck on a lock held at the time
+    with ProcessPoolExecutor(workers, mp_context=get_context('forkserver'),
+                             initializer=_share, initargs=(csr.indptr, csr.indices)) as pool:
+        results = [r for c in pool.map(_reach_chunk, chunks, [steps] * len(chunks)) for r in c]
+
+    return np.array(results, dtype=np.int64).reshape(-1, 3)
+
+
+def _aligned(n):
+    return (n + 7) // 8 * 8
+
+
+def _layout(states, transitions, table, itemsize):
+    """(offset, dtype, count) of every array after the header"""
+    index = np.dtype('<i{}'.format(itemsize))
+    arrays = ((np.dtype('<i8'), states + 1), (np.dtype('u1'), table), (index, states + 1), (index, transitions),
+              (np.dtype('<i8'), transitions))
+    offset = _aligned(HEADER.size)
+
+    for dtype, count in arrays:
+        yield offset, dtype, count
+        offset = _aligned(offset + dtype.itemsize * count)
+
+
+def save(path, vocabulary, csr, serial=None):
+    """writes the model to a temp file and swaps it in, processes mapping the old file keep their pages
+    returns the snapshot serial that delta logs are tied to"""
+    serial = time.time_ns() if serial is None else serial
+    encoded = [t.encode('utf-8', 'surrogatepass') for t in vocabulary]
+    offsets = np.zeros(len(encoded) + 1, dtype='<i8')
+    np.cumsum([len(t) for t in encoded], out=offsets[1:])
+
+    csr.sort_indices()
+    itemsize = csr.indices.dtype.itemsize
+    arrays = (offsets, np.frombuffer(b''.join(encoded), dtype='u1'), csr.indptr, csr.indices, csr.data)
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, serial, len(encoded), csr.nnz, int(offsets[-1]), itemsize)
+
+    temp = path + '.tmp'
+    with open(temp, 'wb') as file:
+        file.write(header)
+        for (offset, dtype, _), array in zip(_layout(len(encoded), csr.nnz, int(offsets[-1]), itemsize), arrays):
+            file.seek(offset)
+            file.write(np.ascontiguousarray(array, dtype=dtype).tobytes())
+
+    os.replace(temp, path)
+    return serial
+
+
+def load(path, mmap=True):
+    """reads a model written by save, csr arrays are memory-mapped read only unless mmap is False"""
+    with open(path, 'rb') as file:
+        magic, version, _, states, transitions, table, itemsize = HEADER.unpack(file.read(HEADER.size))
+
+    if magic != MAGIC:
+        raise ValueError('{} is not a markov model file.'.format(path))
+    if version != FORMAT_VERSION:
+        raise ValueError('Unsupported markov model version {}.'.format(version))
+
+    arrays = []
+    for offset, dtype, count in _layout(states, transitions, table, itemsize):
+        if not count:
+            arrays.append(np.zeros(0, dtype=dtype))
+        elif mmap:
+            arrays.append(np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,)))
+        else:
+            arrays.append(np.fromfile(path, dtype=dtype, count=count, offset=offset))
+
+    offsets, blob, indptr, indices, data = arrays
+    blob = blob.tobytes()
+    tokens = [blob[offsets[i]:offsets[i + 1]].decode('utf-8', 'surrogatepass') for i in range(states)]
+
+    return Vocabulary(tokens), Transitions(csr_matrix((data, indices, indptr), shape=(states, states), copy=False))
+
+
+def migrate(legacy_path, path):
+    """converts a [STATES, TRANSITIONS] pickle into the binary format"""
+    states, transitions = pickle.load(open(legacy_path, 'rb'))
+    save(path, Vocabulary.load(states), Transitions.load(transitions).csr)
+
+
+def snapshot_serial(path):
+    with open(path, 'rb') as file:
+        return HEADER.unpack(file.read(HEADER.size))[2]
+
+
+def append_delta(path, serial, base, tokens, pairs, counts):
+    """appends one record of new states and count increments to a delta log"""
+    # one write, so a concurrent upload of the log sees whole records
+    record = pickle.dumps((serial, base, tokens, pairs, counts))
+    with open(path, 'ab') as file:
+        file.write(record)
+
+
+def replay(path, serial, vocabulary, transitions):
+    """applies the delta log records made on top of snapshot serial, returns how many were applied"""
+    applied = 0
+
+    with open(path, 'rb') as file:
+        while True:
+            try:
+                record_serial, base, tokens, pairs, counts = pickle.load(file)
+            except (EOFError, pickle.UnpicklingError):  # a record cut short by a crash ends the log
+                break
+
+            # records from before the last snapshot were already folded into it
+            if record_serial != serial:
+                continue
+            if base != len(vocabulary):
+                raise ValueError('Delta log record does not follow the markov model.')
+
+            vocabulary.extend(tokens)
+            transitions.resize(len(vocabulary))
+            transitions.update({(int(src), int(dst)): int(n) for (src, dst), n in zip(pairs, counts)})
+            applied += 1
+
+    vocabulary.persisted()
+    transitions.persisted()
+    return applied
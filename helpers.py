@@ -1,22 +1,37 @@
+import atexit
 import csv
+import os
 import re
+from importlib import import_module
+from threading import Lock
 
-import dropbox
-from dropbox.files import WriteMode
+from storage import Storage, DropboxStore, LocalStore
 
-TOKEN_DICT = [l for l in csv.DictReader(open('tokens.csv', 'r'))][0]
-DROPBOX_TOKEN = TOKEN_DICT['dropbox']
+STORE = None  # created on first use, so importing helpers doesn't start the uploader
+STORE_LOCK = Lock()
+
+
+def store():
+    global STORE
+    with STORE_LOCK:
+        if STORE is None:
+            # YOSHO_STORE=<directory> keeps state files in a local directory instead of dropbox
+            if 'YOSHO_STORE' in os.environ:
+                STORE = Storage(LocalStore(os.environ['YOSHO_STORE']))
+            else:
+                token = [l for l in csv.DictReader(open('tokens.csv', 'r'))][0]['dropbox']
+                STORE = Storage(DropboxStore(token))
+            atexit.register(STORE.flush, 60)
+    return STORE
 
-db = dropbox.Dropbox(DROPBOX_TOKEN)
 
 MODS = {'wyreyote', 'teamfortress', 'plusreed', 'pixxo', 'radookal', 'pawjob'}
 
 # not PEP8 compliant but idc
 is_mod = lambda name: name.lower() in MODS
 clean = lambda s: str.strip(re.sub('/[@\w]+\s+', '', s + ' ', 1))  # strips command name and bot name from input
-db_pull = lambda name: db.files_download_to_file(name, '/' + name)
-db_push = lambda name: db.files_upload(open(name, 'rb').read(), '/' + name, mode=WriteMode('overwrite'))
-db_make = lambda name: db.files_upload(open(name, 'rb').read(), '/' + name, mode=WriteMode('add'))
+db_pull = lambda name: store().pull(name)  # skipped if the local copy is already up to date
+db_push = lambda name: store().push(name)  # uploaded in the background, repeated pushes are coalesced
 add_s = lambda n: 's' if n != 1 else ''
 re_url = lambda s: re.sub(r'(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|'
                           r'(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:\'".,<>?«»“”‘'
@@ -24,6 +39,42 @@ re_url = lambda s: re.sub(r'(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-
 re_name = lambda s: re.sub('@\w+', '', s)
 
 
+def db_fetch(name):
+    """pulls name if it exists remotely, returns whether it does"""
+    try:
+        db_pull(name)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+# heavy modules are imported on first attribute access, or when the bot warms them up after startup
+LAZY_MODULES = []
+
+
+class LazyModule:
+    def __init__(self, name, setup=None):
+        self._name = name
+        self._setup = setup  # called once before the import, e.g. to pick a matplotlib backend
+        self._module = None
+
+    def load(self):
+        if self._module is None:
+            if self._setup:
+                self._setup()
+            self._module = import_module(self._name)
+        return self._module
+
+    def __getattr__(self, item):
+        return getattr(self.load(), item)
+
+
+def lazy_import(name, setup=None):
+    module = LazyModule(name, setup)
+    LAZY_MODULES.append(module)
+    return module
+
+
 def build_menu(buttons, n_cols, header_buttons=None, footer_buttons=None):
     menu = [buttons[i:i + n_cols] for i in range(0, len(buttons), n_cols)]
     if header_buttons:
@@ -1,12 +1,59 @@
-from requests import head
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, RLock
+from time import time
+from weakref import WeakSet
+
+from requests import head, RequestException
 import json
 
+PHOTO_TYPES = {'image/png', 'image/jpeg'}
+URL_TTL = 60 * 60  # seconds a url's content type is trusted
+URL_CACHE_SIZE = 1024
+URL_TIMEOUT = 10
+
+_url_cache = {}  # url -> (content type, expiry time)
+_url_lock = Lock()
+_validator = ThreadPoolExecutor(max_workers=4)  # bounds concurrent HEAD requests
+
+
+def content_type(url):
+    """content type of url from a HEAD request, cached for URL_TTL seconds
+    failed requests raise RequestException and aren't cached"""
+    with _url_lock:
+        cached = _url_cache.get(url)
+    if cached and cached[1] > time():
+        return cached[0]
+
+    value = head(url, timeout=URL_TIMEOUT).headers.get('content-type')
+
+    with _url_lock:
+        if len(_url_cache) >= URL_CACHE_SIZE:
+            now = time()
+            for k in [k for k, v in _url_cache.items() if v[1] <= now] or list(_url_cache)[:URL_CACHE_SIZE // 2]:
+                del _url_cache[k]
+        _url_cache[url] = (value, time() + URL_TTL)
+
+    return value
+
+
+def url_expired(url):
+    """whether url's content type would be looked up again"""
+    with _url_lock:
+        cached = _url_cache.get(url)
+    return not cached or cached[1] <= time()
+
 
 class Macro:
     _varieties = ('TEXT', 'EVAL', 'PHOTO', 'INLINE', 'E621', 'ALIAS', 'MARKOV')
     TEXT, EVAL, PHOTO, INLINE, E621, ALIAS, MARKOV = _varieties
+    _fields = ('variety', '_content', 'creator', 'hidden', 'protected', 'nsfw')  # serialized by MacroSet.dump
+
+    # PHOTO url validation states, other varieties are always VALID
+    UNCHECKED, PENDING, VALID, INVALID = 'UNCHECKED', 'PENDING', 'VALID', 'INVALID'
 
     def __init__(self, name, variety, content, creator='', hidden=False, protected=False, nsfw=False):
+        self._owners = WeakSet()  # MacroSets indexing this macro, told about every change
         self.name = str(name)
         self.variety = variety
         self._content = None
@@ -22,18 +69,52 @@ class Macro:
 
     @content.setter
     def content(self, value):
-        if self.variety == Macro.PHOTO:
-            if head(value).headers.get('content-type') not in {'image/png', 'image/jpeg'}:
-                raise ValueError('PHOTO macro content is not a photo url.')
+        # photo urls aren't checked here, see validate
         self._content = value
+        self.status = Macro.UNCHECKED if self.variety == Macro.PHOTO else Macro.VALID
+
+    def validate(self, callback=None):
+        """checks a PHOTO url on the validator pool without blocking, status is PENDING until it finishes
+        callback(macro, valid) is called from the pool thread, not at all if the url couldn't be reached"""
+        if self.variety != Macro.PHOTO:
+            return
+
+        url = self._content
+        self.status = Macro.PENDING
+
+        def check():
+            try:
+                valid = content_type(url) in PHOTO_TYPES
+            except RequestException:
+                # says nothing about the url, checked again on next use
+                if self._content == url:
+                    self.status = Macro.UNCHECKED
+                return
+
+            if self._content == url:  # content may have changed while this was running
+                self.status = Macro.VALID if valid else Macro.INVALID
+            if callback:
+                callback(self, valid)
+
+        _validator.submit(check)
+
+    def __setattr__(self, key, value):
+        old = self.__dict__.get(key)
+        super().__setattr__(key, value)
+
+        for s in self.__dict__.get('_owners', ()):
+            s._changed(self, key, old)
 
     def __repr__(self):
         return 'Macro "{}": {} "{}"'.format(self.name, self.variety, self._content)
 
 
 class MacroSet:
+    _flags = ('hidden', 'protected', 'nsfw')
 
-    def subset(self, match=None, search=None, variety=None, hidden=False, protected=None, nsfw=None, filt=None):
+    def subset(self, match=None, search=None, variety=None, hidden=False, protected=None, nsfw=None, filt=None,
+               sort=False):
+        """matching macros as a new MacroSet, or with sort as a cached tuple sorted by name"""
         convert = lambda s: None if s == 'None' else s == 'True'
 
         if filt:
@@ -56,29 +137,156 @@ class MacroSet:
             if 'nsfw' in k:
                 nsfw = convert(filt['nsfw'])
 
-        return MacroSet({m for m in self._macros if all((hidden is None or m.hidden == hidden,
-                                                         protected is None or m.protected == protected,
-                                                         nsfw is None or m.nsfw == nsfw,
-                                                         variety is None or variety in {m.variety.lower(), m.variety},
-                                                         match is None or m.name == match,
-                                                         search is None or search in m.name))})
+        key = ('subset', match, search, variety, hidden, protected, nsfw)
+        with self._lock:
+            # built into locals, another thread's change may clear _views in between
+            names = self._views.get(key)
+            if names is None:
+                names = self._views[key] = tuple(self._select(match, search, variety, {'hidden': hidden,
+                                                                                       'protected': protected,
+                                                                                       'nsfw': nsfw}))
+            macros = [self._macros[n] for n in names]
+
+            if sort:
+                # cached here, a new MacroSet would start without views and register with every macro it holds
+                ordered = self._views.get(key + ('sort',))
+                if ordered is None:
+                    ordered = self._views[key + ('sort',)] = tuple(sorted(macros, key=lambda m: m.name))
+                return ordered
+
+        return MacroSet(macros)
+
+    def search(self, text):
+        """names containing text"""
+        with self._lock:
+            self._build()
+
+            if len(text) < 3:
+                return {n for n in self._macros if text in n}
+
+            postings = sorted((self._grams.get(g, set()) for g in MacroSet._trigrams(text)), key=len)
+            return {n for n in set.intersection(*postings) if text in n}
+
+    def _select(self, match, search, variety, flags):
+        self._build()
+
+        # intersect the smallest candidate sets first, then drop macros with excluded flags
+        include = [self._flagged[f] for f, v in flags.items() if v is True]
+        if match is not None:
+            include.append({match} & self._macros.keys())
+        if variety is not None:
+            include.append(self._varieties.get(variety.upper(), set()))
+        if search is not None:
+            include.append(self.search(search))
+
+        names = set.intersection(*sorted(include, key=len)) if include else set(self._macros)
+        for f, v in flags.items():
+            if v is False:
+                names -= self._flagged[f]
+
+        return names
+
+    @staticmethod
+    def _trigrams(name):
+        return {name[i:i + 3] for i in range(len(name) - 2)}
+
+    # secondary indexes are built on first use and then kept up to date by _changed
+    def _build(self):
+        if self._indexed:
+            return
+
+        self._varieties, self._grams = {}, {}
+        self._flagged = {f: set() for f in MacroSet._flags}
+        self._indexed = True
+
+        for m in self._macros.values():
+            self._index(m)
+
+    def _index(self, macro, add=True, old=None):
+        if not self._indexed:
+            return
+
+        values = {k: getattr(macro, k) for k in ('name', 'variety') + MacroSet._flags}
+        values.update(old or {})
+        name = values['name']
+        update = set.add if add else set.discard
+
+        update(self._varieties.setdefault(values['variety'].upper(), set()), name)
+        for f in MacroSet._flags:
+            if values[f]:
+                update(self._flagged[f], name)
+        for g in MacroSet._trigrams(name):
+            update(self._grams.setdefault(g, set()), name)
+
+    def _changed(self, macro, key, old):
+        if key not in ('name',) + Macro._fields:
+            return
+
+        with self._lock:
+            if key in ('name', 'variety') + MacroSet._flags:
+                self._index(macro, add=False, old={key: old})
+
+                if key == 'name':
+                    del self._macros[old]
+                    self._macros[macro.name] = macro
+
+                self._index(macro)
+
+            self._views = {}
+            self.generation += 1
 
     def add(self, value):
-        self._macros.add(value)
+        with self._lock:
+            if value.name in self._macros:
+                self.remove(value.name)
+
+            self._macros[value.name] = value
+            value._owners.add(self)
+            self._index(value)
+            self._views = {}
+            self.generation += 1
 
     def remove(self, key):
-        if key in self:
-            self._macros.remove(self[key])
-        else:
-            raise KeyError
+        with self._lock:
+            macro = self._macros[key]
+            self._index(macro, add=False)
+            macro._owners.discard(self)
+            del self._macros[key]
+            self._views = {}
+            self.generation += 1
+
+    def rename(self, key, name):
+        """renames a macro, the index of every set holding it follows through _changed"""
+        with self._lock:
+            macro = self._macros[key]
+            # any of those sets would otherwise drop its own macro by that name
+            if any(name in s for s in list(macro._owners)):
+                raise KeyError('Macro {} already exists.'.format(name))
+
+            macro.name = name
 
     def sort(self):
-        return sorted(self._macros, key=lambda m: m.name)
+        with self._lock:
+            ordered = self._views.get('sort')
+            if ordered is None:
+                ordered = self._views['sort'] = tuple(sorted(self._macros.values(), key=lambda m: m.name))
+        return list(ordered)
+
+    @staticmethod
+    def dump(mset, file, compact=False):
+        serializable = {m.name: {k: getattr(m, k) for k in Macro._fields} for m in mset}
+        if compact:
+            json.dump(serializable, file, separators=(',', ':'), sort_keys=True)
+        else:
+            json.dump(serializable, file, indent=4, sort_keys=True)
 
     @staticmethod
-    def dump(mset, file):
-        serializable = {m.name: {k: v for k, v in m.__dict__.items() if not k == 'name'} for m in mset}
-        json.dump(serializable, file, indent=4, sort_keys=True)
+    def save(mset, path, compact=False):
+        """dumps to a temp file and swaps it in, a crash mid-write never leaves a truncated file"""
+        temp = path + '.tmp'
+        with open(temp, 'w') as file:
+            MacroSet.dump(mset, file, compact=compact)
+        os.replace(temp, path)
 
     @staticmethod
     def load(file):
@@ -92,35 +300,42 @@ class MacroSet:
                                nsfw=data[k]['nsfw']) for k, v in data.items()})
 
     def __init__(self, macros):
-        self._macros = set(macros)
+        self._macros = {}  # name -> Macro
+        self._views = {}  # cached subset names and sorted listings, cleared on any change
+        self._indexed = False
+        self._lock = RLock()  # plugins handle updates for different chats on different threads
+        self.generation = 0  # bumped on every change to the set or its macros
+
+        for m in macros:
+            self.add(m)
 
     def __len__(self):
         return len(self._macros)
 
     def __iter__(self):
-        return iter(self._macros)
+        with self._lock:
+            return iter(list(self._macros.values()))
 
     def __contains__(self, name):
-        return name in (m.name for m in self._macros)
+        return name in self._macros
 
     def __getitem__(self, item):
-        m = next((m for m in self._macros if m.name == item), None)
-        if m is None:
-            raise KeyError
-        return m
+        return self._macros[item]
 
     def __setitem__(self, key, value):
         if key in self._macros:
             self.remove(key)
             self.add(value)
         else:
-            raise KeyError
+            raise KeyError(key)
 
     def __add__(self, macros):
-        return MacroSet(self._macros.union(macros))
+        # macros already in this set win name collisions
+        return MacroSet(list(macros) + list(self._macros.values()))
 
     def __sub__(self, macros):
-        return MacroSet(self._macros.difference(macros))
+        names = {m.name for m in macros}
+        return MacroSet(m for m in self._macros.values() if m.name not in names)
 
     def __repr__(self):
-        return 'MacroSet {{{}}}'.format(', '.join((repr(m) for m in self._macros)))
+        return 'MacroSet {{{}}}'.format(', '.join((repr(m) for m in self._macros.values())))
@@ -49,12 +49,7 @@ def set_global(bot, update, bot_globals):
         if args[0] in names:
             if str(args[1]).isnumeric():
                 bot_globals['GLOBALS'][args[0]] = int(args[1])
-
-                for k, g in bot_globals.items():
-                    if isinstance(g, (int, bool)):
-                        if k in bot_globals['GLOBALS'].keys():
-                            bot_globals[k] = bot_globals['GLOBALS'][k]
-                bot_globals['logger'].level = bot_globals['LOGGING_LEVEL']
+                bot_globals['load_globals']()
 
                 pickle.dump(bot_globals['GLOBALS'], open(bot_globals['GLOBALS_PATH'], 'wb+'))
                 db_push(bot_globals['GLOBALS_PATH'])
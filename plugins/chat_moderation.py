@@ -2,7 +2,9 @@
 import pickle
 
 from telegram import ChatAction as Ca
-from telegram.ext import CommandHandler
+from telegram.ext import CommandHandler, MessageHandler
+from telegram.ext.filters import Filters
+
 from helpers import db_push
 
 handlers = []
@@ -24,4 +26,35 @@ def sfw(bot, update, bot_globals):
     update.message.reply_text(text='Chat {} is SFW only: {}'.format(name, bot_globals['SFW'][name]))
 
 
-handlers.append([CommandHandler("sfw", sfw), {'age': False, 'flood': False, 'admins': True, 'action': Ca.TYPING}])
\ No newline at end of file
+handlers.append([CommandHandler("sfw", sfw), {'age': False, 'flood': False, 'admins': True, 'action': Ca.TYPING}])
+
+
+def refresh_admins(bot, update, bot_globals):
+    """reloads this chat's administrator list"""
+    bot_globals['invalidate_admins'](update.message.chat_id)
+    update.message.reply_text(text='Administrator list will be refreshed.')
+
+
+handlers.append([CommandHandler('refresh_admins', refresh_admins), {'age': False, 'action': Ca.TYPING}])
+
+
+def admin_cache(bot, update, bot_globals):
+    """displays chat administrator cache stats"""
+    stats = bot_globals['ADMIN_STATS']
+    lookups = stats['hits'] + stats['misses']
+    rate = round(stats['hits'] / lookups * 100, 2) if lookups else 0
+
+    update.message.reply_text(text='Admin cache: {} hits, {} misses ({}% hit rate)\n{} invalidations, {} chats cached.'
+                              .format(stats['hits'], stats['misses'], rate, stats['invalidations'],
+                                      len(bot_globals['ADMINS'])))
+
+
+handlers.append([CommandHandler('admin_cache', admin_cache), {'action': Ca.TYPING, 'mods': True}])
+
+
+def chat_update(bot, update, bot_globals):
+    """refreshes administrators when members join or leave"""
+    bot_globals['invalidate_admins'](update.message.chat_id)
+
+
+handlers.append([MessageHandler(filters=Filters.status_update, callback=chat_update), None, 1])
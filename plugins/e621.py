@@ -17,17 +17,11 @@ handlers = []
 # noinspection PyUnusedLocal
 def e621(bot, update, bot_globals, tags=None):
     """queries e621/e926 and posts a random image from the first 50 results"""
-    def no_flood(u):
-        bot_globals['last_commands'][u] = time.time() - bot_globals['MESSAGE_TIMEOUT'] * 2
-
     failed = 'e621 error:\n\n'
 
     logger = bot_globals['logger']
     sfw = bot_globals['SFW']
 
-    message = update.message
-    message_user = message.from_user.username if message.from_user.username is not None else message.from_user.name
-
     index = 'https://e621.net/post/index.json'
     chat = update.message.chat
     name = chat.title if chat.username is None else '@' + chat.username
@@ -38,7 +32,7 @@ def e621(bot, update, bot_globals, tags=None):
     if tags is None:
         tags = clean(update.message.text)
     else:
-        no_flood(message_user)
+        bot_globals['no_flood'](update)
 
     # construct the request
     params = {'limit': '50', 'tags': tags}
@@ -66,4 +60,4 @@ def e621(bot, update, bot_globals, tags=None):
         update.message.reply_text(text=failed + 'e621 API error.')
 
 
-handlers.append([CommandHandler("e621", e621), {'action': Ca.UPLOAD_PHOTO}])
+handlers.append([CommandHandler("e621", e621), {'action': Ca.UPLOAD_PHOTO, 'flood': 'heavy'}])
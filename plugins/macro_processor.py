@@ -1,13 +1,9 @@
 """yosho plugin:macro processor"""
+import io
 import logging
 import re
-import time
 from datetime import datetime
 
-import matplotlib
-import stopit
-from asteval import Interpreter
-from scipy.special import gamma
 from telegram import ChatAction as Ca
 from telegram import InlineQueryResultArticle, InputTextMessageContent
 from telegram.error import TelegramError
@@ -15,36 +11,46 @@ from telegram.ext import CommandHandler, InlineQueryHandler, MessageHandler
 from telegram.ext.filters import Filters
 
 from helpers import clean
-from helpers import is_mod, db_push, db_pull
-from macro import Macro, MacroSet
-
-matplotlib.use('Agg')
-
-import matplotlib.pyplot as plt
+from helpers import is_mod, db_push, add_s
+from macro import Macro, MacroSet, url_expired
+from sandbox import EvalPool, EvalError, ResultCache, reads
+from sessions import SessionStore
 
 ORDER = 2
 
+EVAL_PERSIST = False  # keep eval sessions in SESSIONS.pkl across restarts
+
 MACROS_PATH = 'MACROS.json'
-db_pull(MACROS_PATH)
-MACROS = MacroSet.load(open(MACROS_PATH, 'rb'))
+SESSIONS_PATH = 'SESSIONS.pkl'
+STATE_FILES = [MACROS_PATH, SESSIONS_PATH] if EVAL_PERSIST else [MACROS_PATH]  # pulled at startup, loaded in init
+MACROS = MacroSet([])
+MACROS_COMPACT = False  # write MACROS.json without indentation
+FLUSHED = MACROS.generation  # generation of MACROS last written to MACROS.json
 
 EVAL_MEMORY = True
 EVAL_TIMEOUT = 6
 MOD_TIMEOUT = 60 * 2
 EVAL_MAX_OUTPUT = 256
 EVAL_MAX_INPUT = 10000
+EVAL_WORKERS = 2  # worker processes, evals beyond this many at once wait for one
+EVAL_MEMORY_LIMIT = 256 * 2 ** 20  # bytes a worker may allocate past its imports
+EVAL_MAX_TASKS = 100  # evals before a worker is replaced
 
-INTERPRETERS = {}
-handlers = []
+SANDBOX = None  # started in init, once the bot's own imports are done so workers inherit them
 
+EVAL_CACHE_SIZE = 256  # outputs of EVAL macros that only depend on their inputs, 0 disables
+RESULTS = ResultCache(EVAL_CACHE_SIZE)
 
-def evaluate(bot, update, bot_globals, cmd=None, symbols=None):
-    """safely evaluates simple python code and generates plots"""
+EVAL_MEMORY_BUDGET = 32 * 2 ** 20  # compressed bytes of eval variables kept for all users together
+EVAL_USER_MEMORY = 2 ** 20  # and for any one user, larger sessions aren't saved
+INTERPRETER_TIMEOUT = 60 * 60  # seconds a user's variables are kept after their last eval
+
+SESSIONS = SessionStore(EVAL_MEMORY_BUDGET, EVAL_USER_MEMORY, INTERPRETER_TIMEOUT)
+handlers = []
 
-    def no_flood(u):
-        bot_globals['last_commands'][u] = time.time() - bot_globals['MESSAGE_TIMEOUT'] * 2
 
-    global INTERPRETERS
+def evaluate(bot, update, bot_globals, cmd=None, symbols=None, macro_name=None):
+    """safely evaluates simple python code and generates plots"""
     user = update.message.from_user
     message_user = user.username if user.username is not None else user.name
 
@@ -54,7 +60,7 @@ def evaluate(bot, update, bot_globals, cmd=None, symbols=None):
 
     if expr == '':
         update.message.text = '/eval_info' + bot.name.lower()
-        no_flood(message_user)
+        bot_globals['no_flood'](update)
         call_macro(bot, update, bot_globals)
         return
 
@@ -63,10 +69,10 @@ def evaluate(bot, update, bot_globals, cmd=None, symbols=None):
         return
 
     name = update.message.from_user.name
-    interp = Interpreter(max_time=100000)
-    if EVAL_MEMORY and name in INTERPRETERS.keys():
-        interp.symtable = {**INTERPRETERS[name], **Interpreter().symtable}
-        bot_globals['logger'].debug('Loaded interpreter "{}": {}'.format(name, INTERPRETERS[name]))
+    memory = {}
+    if EVAL_MEMORY and name in SESSIONS:
+        memory = SESSIONS.get(name)
+        bot_globals['logger'].debug('Loaded interpreter "{}": {}'.format(name, memory))
 
     quoted = update.message.reply_to_message
     preceding = '' if quoted is None else quoted.text
@@ -81,50 +87,36 @@ def evaluate(bot, update, bot_globals, cmd=None, symbols=None):
                              'PRECEDING': preceding,
                              'GROUP': (chat.title if chat.username is None else '@' + chat.username),
                              'REPLY': True,
-                             'TIME': tuple(datetime.now().timetuple()),
-                             'gamma': gamma}}
-
-    interp.symtable = {**interp.symtable, **symbols}
-
-    timeout = MOD_TIMEOUT if is_mod(message_user) else EVAL_TIMEOUT
-    with stopit.ThreadingTimeout(timeout):
-        result = interp(expr)
-        str_result = str(result).strip()
-        if 'PLOT_TYPE' in interp.symtable.keys() and isinstance(interp.symtable['PLOT_TYPE'], str):
-            plot_type = interp.symtable['PLOT_TYPE']
-            plot_args = interp.symtable['PLOT_ARGS'] if 'PLOT_ARGS' in interp.symtable.keys() and \
-                                                        isinstance(interp.symtable['PLOT_ARGS'], tuple) else tuple()
-            plot_kwargs = interp.symtable['PLOT_KWARGS'] if 'PLOT_KWARGS' in interp.symtable.keys() and \
-                                                            isinstance(interp.symtable['PLOT_KWARGS'], dict) else dict()
-
-            if plot_type in {'plot', 'scatter', 'contour', 'hist', 'contourf'}:
-                try:
-                    getattr(plt, plot_type)(*plot_args, **plot_kwargs)
-                    plt.savefig('temp.jpeg')
-                    plt.clf()
-
-                except Exception as e:
-                    del interp.symtable['PLOT_TYPE']
-                    str_result = err + 'Error in pyplot: ' + e.__class__.__name__
-
-            else:
-                del interp.symtable['PLOT_TYPE']
-                str_result = err + 'Unsupported plot type.'
-
-        elif 'PLOT_TYPE' in interp.symtable.keys():
-            del interp.symtable['PLOT_TYPE']
-            str_result = err + 'Plot type must be a string.'
+                             'TIME': tuple(datetime.now().timetuple())}}
+
+    # EVAL macros that read nothing but injected symbols are cached on the values of the ones they read
+    key = None
+    if macro_name is not None and EVAL_CACHE_SIZE:
+        used = reads(expr, frozenset(symbols))
+        if used is not None:
+            key = (macro_name, expr, tuple((k, symbols[k]) for k in sorted(used)))
+
+    output = RESULTS.get(key) if key else None
+    if output is None:
+        # runs in a worker process, which is killed if it overruns the timeout or its memory limit
+        timeout = MOD_TIMEOUT if is_mod(message_user) else EVAL_TIMEOUT
+        try:
+            # a cached output must not depend on whose saved variables it ran with
+            output = SANDBOX.run(expr, {} if key else memory, symbols, timeout)
+        except EvalError as e:
+            update.message.reply_text(text=err + str(e))
+            return
 
-    reply = interp.symtable['REPLY']
+        if key:
+            RESULTS.put(key, {**output, 'memory': {}})
 
-    if EVAL_MEMORY and cmd is None and not any(p in set(interp.symtable.keys()) for p in ('PLOT_TYPE',
-                                                                                          'PLOT_ARGS',
-                                                                                          'PLOT_KWARGS')):
-        INTERPRETERS[name] = {k: v for k, v in interp.symtable.items() if k not in
-                              Interpreter().symtable.keys() and k not in symbols.keys()}
-        bot_globals['logger'].debug('Saved interpreter "{}": {}'.format(name, INTERPRETERS[name]))
+    str_result, reply, errors = output['result'], output['reply'], output['errors']
 
-    errors = set([e.get_error()[0] for e in interp.error])
+    if EVAL_MEMORY and cmd is None and not output['plotting']:
+        if SESSIONS.put(name, output['memory']):
+            bot_globals['logger'].debug('Saved interpreter "{}": {}'.format(name, output['memory']))
+        else:
+            bot_globals['logger'].debug('Interpreter "{}" too large to save'.format(name))
 
     if errors:
         update.message.reply_text(text=err + ' ,'.join(errors))
@@ -133,17 +125,18 @@ def evaluate(bot, update, bot_globals, cmd=None, symbols=None):
         if len(str_result) > EVAL_MAX_OUTPUT:
             str_result = str_result[:EVAL_MAX_OUTPUT] + '...'
 
-        if 'PLOT_TYPE' in interp.symtable.keys():
-            if result is None:
+        if output['plot'] is not None:
+            if output['none']:
                 str_result = ''
 
+            photo = io.BytesIO(output['plot'])
             if reply:
                 if quoted is None:
-                    update.message.reply_photo(photo=open('temp.jpeg', 'rb'), caption=str_result)
+                    update.message.reply_photo(photo=photo, caption=str_result)
                 else:
-                    quoted.reply_photo(photo=open('temp.jpeg', 'rb'), caption=str_result)
+                    quoted.reply_photo(photo=photo, caption=str_result)
             else:
-                bot.send_photo(photo=open('temp.jpeg', 'rb'), caption=str_result, chat_id=update.message.chat.id)
+                bot.send_photo(photo=photo, caption=str_result, chat_id=update.message.chat.id)
 
         else:
             if not str_result:
@@ -165,11 +158,6 @@ handlers.append([CommandHandler("eval", evaluate), {'action': Ca.TYPING}])
 def macro(bot, update, bot_globals):
     """user defined macro editor"""
 
-    def no_flood(u):
-        bot_globals['last_commands'][u] = time.time() - bot_globals['MESSAGE_TIMEOUT'] * 2
-
-    global MACROS
-
     message = update.message
     message_user = message.from_user.username if message.from_user.username is not None else message.from_user.name
 
@@ -193,9 +181,15 @@ def macro(bot, update, bot_globals):
     err = 'Macro editor error:\n\n'
     expr = clean(message.text)
 
+    # photo urls are checked in the background, only failures get a reply
+    def bad_photo(m, valid):
+        if not valid:
+            message.reply_text(text=err + 'Bad photo url, macro {} will not be sent until it is modified.'
+                               .format(m.name))
+
     if expr == '':
         update.message.text = '/macro_help' + bot.name.lower()
-        no_flood(message_user)
+        bot_globals['no_flood'](update)
         call_macro(bot, update, bot_globals)
         return
 
@@ -228,25 +222,23 @@ def macro(bot, update, bot_globals):
 
     if modes[mode] == 'macro' and name not in MACROS:
         if expr:
-            try:
-                MACROS.add(Macro(name, mode.upper(), expr, hidden=False, protected=is_mod(user), nsfw=False,
-                                 creator={'user': message_user,
-                                          'chat': message.chat.id,
-                                          'chat_type': message.chat.type}))
-
-                message.reply_text(text='{} macro "{}" created.'.format(mode, name))
-            except ValueError:
-                message.reply_text(text=err + 'Bad photo url.')
+            m = Macro(name, mode.upper(), expr, hidden=False, protected=is_mod(user), nsfw=False,
+                      creator={'user': message_user,
+                               'chat': message.chat.id,
+                               'chat_type': message.chat.type})
+            MACROS.add(m)
+            m.validate(callback=bad_photo)
+
+            message.reply_text(text='{} macro "{}" created.'.format(mode, name))
         else:
             message.reply_text(text=err + 'Missing macro contents.')
 
     elif mode == 'modify':
         if name in MACROS and expr is not None:
-            try:
-                MACROS[name].content = expr
-                message.reply_text(text='Macro "{}" modified.'.format(name))
-            except ValueError:
-                message.reply_text(text=err + 'Bad photo url.')
+            MACROS[name].content = expr
+            MACROS[name].validate(callback=bad_photo)
+            RESULTS.invalidate(name)
+            message.reply_text(text='Macro "{}" modified.'.format(name))
         elif expr is None:
             message.reply_text(text=err + 'Missing macro text/code.')
         else:
@@ -254,7 +246,10 @@ def macro(bot, update, bot_globals):
 
     elif mode == 'clean':
         if is_mod(user):
-            MACROS = MACROS.subset(protected=True)
+            # removed in place so MACROS keeps its generation count
+            for m in MACROS - MACROS.subset(protected=True):
+                MACROS.remove(m.name)
+                RESULTS.invalidate(m.name)
             message.reply_text('Cleaned up macros.')
         else:
             message.reply_text(text=err + 'Only bot mods can do that.')
@@ -262,15 +257,24 @@ def macro(bot, update, bot_globals):
     elif mode == 'remove':
         if name in MACROS:
             MACROS.remove(name)
+            RESULTS.invalidate(name)
             message.reply_text(text='Macro "{}" removed.'.format(name))
         else:
             message.reply_text(text=err + 'No macro with name {}.'.format(name))
 
     elif mode == 'rename':
         if name in MACROS:
-            new_name = args[1]
-            MACROS[name].name = new_name
-            message.reply_text(text='Macro "{}" renamed to {}'.format(name, new_name))
+            if len(args) < 3:
+                message.reply_text(text=err + 'Missing new macro name.')
+                return
+
+            new_name = args[2]
+            try:
+                MACROS.rename(name, new_name)
+                RESULTS.invalidate(name)
+                message.reply_text(text='Macro "{}" renamed to {}'.format(name, new_name))
+            except KeyError:
+                message.reply_text(text=err + 'Macro {} already exists.'.format(new_name))
         else:
             message.reply_text(text=err + 'No macro with name {}.'.format(name))
 
@@ -281,20 +285,21 @@ def macro(bot, update, bot_globals):
             exclude = {i.split(':')[0][1:]: i.split(':')[1] for i in args[1:] if ':' in i and i.startswith('-')}
 
             try:
-                macros = MACROS.subset(filt=include)
+                macros = MACROS.subset(filt=include, sort=True)
                 if exclude:
-                    macros -= MACROS.subset(filt=exclude)
+                    excluded = {m.name for m in MACROS.subset(filt=exclude, sort=True)}
+                    macros = [m for m in macros if m.name not in excluded]
             except ValueError:
                 message.reply_text(text=err + 'Unknown key in list filter: {}.'.format(filt))
                 return
 
             if macros:
-                names = ((bot.name + ' ') * (m.variety == Macro.INLINE) + m.name for m in macros.sort())
+                names = ((bot.name + ' ') * (m.variety == Macro.INLINE) + m.name for m in macros)
                 message.reply_text('Macros:\n' + ', '.join(names))
             else:
                 message.reply_text(text=err + 'No macros found.')
         else:
-            names = ((bot.name + ' ') * (m.variety == Macro.INLINE) + m.name for m in MACROS.subset())
+            names = ((bot.name + ' ') * (m.variety == Macro.INLINE) + m.name for m in MACROS.subset(sort=True))
             message.reply_text('Visible macros:\n' + ', '.join(names))
 
     elif mode == 'contents':
@@ -364,9 +369,10 @@ handlers.append([InlineQueryHandler(inline_stuff), None])
 
 
 def manual_flush(bot, update):
-    """flushes interpreters and macro edits"""
-    flush(bot, None)
-    update.message.reply_text(text='Cleared interpreters and pushed macro updates.')
+    """expires eval sessions and pushes macro edits"""
+    expired, pushed = flush(bot, None)
+    update.message.reply_text(text='Expired {} eval session{}, {}.'
+                              .format(expired, add_s(expired), 'pushed macro updates' if pushed else 'no macro updates'))
 
 
 handlers.append([CommandHandler("flush", manual_flush), {'mods': True, 'action': Ca.TYPING, 'level': logging.DEBUG}])
@@ -424,12 +430,23 @@ def call_macro(bot, update, bot_globals):  # process macros and invalid commands
                 symbols = {'INPUT': clean(message.text),
                            'HIDDEN': MACROS[command].hidden,
                            'PROTECTED': MACROS[command].protected}
-                evaluate(bot, update, bot_globals, cmd=content, symbols=symbols)
+                evaluate(bot, update, bot_globals, cmd=content, symbols=symbols, macro_name=command)
 
             elif variety == Macro.TEXT:
                 known(content)
 
             elif variety == Macro.PHOTO:
+                m = MACROS[command]
+                if m.status == Macro.INVALID:
+                    # the url may have been fixed since, check it again once its last check expires
+                    if url_expired(content):
+                        m.validate()
+                    known(err + "{}'s photo url is invalid.".format(command))
+                    return
+
+                # urls loaded from MACROS.json are only checked on first use, or after a failed request
+                if m.status == Macro.UNCHECKED:
+                    m.validate()
                 photo(content)
 
             elif variety == Macro.E621:
@@ -442,9 +459,11 @@ def call_macro(bot, update, bot_globals):  # process macros and invalid commands
 
             elif variety == Macro.MARKOV:
                 if 'markov generator' in bot_globals['PLUGINS'].keys():
-                    bot.sendChatAction(chat_id=message.chat_id, action=Ca.TYPING)
-                    bot_globals['PLUGINS']['markov generator'].markov(bot, update, bot_globals, seed=
-                    '{}{}'.format(content, (bool(clean(message.text)) * ' ') + clean(message.text)))
+                    seed = '{}{}'.format(content, (bool(clean(message.text)) * ' ') + clean(message.text))
+                    try:
+                        known(bot_globals['PLUGINS']['markov generator'].sentences(seed=seed)[0])
+                    except LookupError as e:
+                        known(err + str(e))
                 else:
                     update.message.reply_text(err + "Markov generator plugin isn't installed.")
 
@@ -465,11 +484,33 @@ handlers.append([MessageHandler(filters=Filters.command, callback=call_macro), {
 
 
 def flush(bot, job):
-    global INTERPRETERS
-    INTERPRETERS = {}
-    MacroSet.dump(MACROS, open(MACROS_PATH, 'w+'))
+    """expires eval sessions and pushes macro edits, returns (sessions expired, whether macros were pushed)"""
+    global FLUSHED
+    expired = SESSIONS.expire()
+
+    if EVAL_PERSIST:
+        with open(SESSIONS_PATH, 'wb') as file:
+            SESSIONS.dump(file)
+        db_push(SESSIONS_PATH)
+
+    if MACROS.generation == FLUSHED:
+        return expired, False
+
+    generation = MACROS.generation
+    MacroSet.save(list(MACROS), MACROS_PATH, compact=MACROS_COMPACT)
     db_push(MACROS_PATH)
+    FLUSHED = generation
+    return expired, True
 
 
 def init(bot_globals):
+    global MACROS, FLUSHED, SANDBOX
+    SANDBOX = EvalPool(EVAL_WORKERS, EVAL_MEMORY_LIMIT, EVAL_MAX_TASKS)
+    if bot_globals['STATE'].get(MACROS_PATH):
+        with open(MACROS_PATH, 'rb') as file:
+            MACROS = MacroSet.load(file)
+        FLUSHED = MACROS.generation
+    if EVAL_PERSIST and bot_globals['STATE'].get(SESSIONS_PATH):
+        with open(SESSIONS_PATH, 'rb') as file:
+            SESSIONS.load(file)
     bot_globals['jobs'].run_repeating(flush, interval=bot_globals['FLUSH_INTERVAL'])
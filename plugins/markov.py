@@ -1,37 +1,59 @@
 """yosho plugin:markov generator"""
-import pickle
 import string
 import time
-from math import sqrt
+from collections import Counter
+from functools import lru_cache
+from queue import Queue, Empty, Full
+from random import random
+from threading import RLock, Thread
 
 import emoji
-import matplotlib
+import numpy as np
 from autocorrect import spell
 from autocorrect.word import KNOWN_WORDS
-from nltk.tokenize import PunktSentenceTokenizer
-from numpy.random import choice
-from scipy.sparse import lil_matrix, hstack, vstack, find
 from telegram import ChatAction as Ca
 from telegram.ext import CommandHandler, MessageHandler
 from telegram.ext.filters import Filters
 
-from helpers import db_push, db_pull, clean, add_s, re_url, re_name
+import chain
+from chain import Vocabulary, Transitions, reach, reachability
+from helpers import db_push, db_pull, clean, add_s, re_url, re_name, lazy_import
 
-matplotlib.use('Agg')
-
-import networkx as nx
-import matplotlib.pyplot as plt
+render = lazy_import('render')
+nx = lazy_import('networkx')
+punkt = lazy_import('nltk.tokenize.punkt')
 
 ORDER = 0
 
-MARKOV_PATH = 'MARKOV.pkl'
+MARKOV_PATH = 'MARKOV.bin'
+LEGACY_PATH = 'MARKOV.pkl'  # pickled [STATES, TRANSITIONS] used before the binary format
+DELTA_PATH = 'MARKOV.delta'  # append-only log of new states and counts since the last snapshot
+SNAPSHOT_INTERVAL = 12  # delta flushes before the log is compacted into a full snapshot
 
 MAX_INPUT_SIZE = 256
 MIN_OUTPUT_STATES = 4
 MAX_OUTPUT_STATES = 50
 
-db_pull(MARKOV_PATH)
-STATES, TRANSITIONS = pickle.load(open(MARKOV_PATH, 'rb'))
+POOL_SIZE = 32  # unseeded sentences generated per batch
+POOL = []
+POOL_SAMPLER = None  # sampler the pooled walks came from, a new one is built after every change
+
+INGEST_QUEUE_SIZE = 1024  # messages waiting for the ingest worker
+INGEST_BATCH_SIZE = 64
+INGEST = Queue(maxsize=INGEST_QUEUE_SIZE)
+INGEST_STATS = {'processed': 0, 'dropped': 0, 'lag': 0.0}
+
+LOCK = RLock()  # guards STATES and TRANSITIONS between the ingest worker and command handlers
+TOKENIZER = None
+
+REACH_WORKERS = None  # processes used by /reachability, defaults to the cpu count
+
+# pulled by the bot at startup alongside every other plugin's state, loaded in init
+STATE_FILES = [MARKOV_PATH, DELTA_PATH]
+
+STATES, TRANSITIONS = Vocabulary(), Transitions()
+SERIAL = None
+DELTAS = 0
 
 handlers = []
 
@@ -44,7 +66,15 @@ REPLACE = {"im": "I'm", "ive": "I've", "id": "I'd", "idve": "I'd've", "hes": "he
            "youre": "you're", "youll": "you'll", "thats": "that's", "xd": "xD", "dont": "don't", "youd": "you'd",
            "whats": "what's", "owo": "OwO", "uwu": "UwU", "theyre": "they're"}
 
+PUNCTUATION = set(string.punctuation)
+UPPERCASE = set(string.ascii_uppercase)
+ASCII = set(string.ascii_letters + string.punctuation)
+CAPITALIZE = PUNCTUATION | {'I', "I'm", "I've", "I'd", "I'd've", "I'll", "i", "i'm", "i've", "i'd", "i'd've", "i'll"}
+
+TOKEN_CACHE_SIZE = 2 ** 16  # normalized tokens kept, spell correction is by far the slowest step
 
+
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
 def process_token(token):
     if any(c in emoji.EMOJI_UNICODE for c in token):
         return token.lower()
@@ -54,8 +84,7 @@ def process_token(token):
         return REPLACE[token.lower()]
 
     # punctuation and capitalization check
-    if token in set(string.punctuation) | {'I', "I'm", "I've", "I'd", "I'd've", "I'll",
-                                       "i", "i'm", "i've", "i'd", "i'd've", "i'll"}:
+    if token in CAPITALIZE:
         return token.capitalize()
 
     # known word check
@@ -63,122 +92,137 @@ def process_token(token):
         return token.lower()
 
     # acronym and contraction check
-    if all(c in set(string.ascii_uppercase) for c in token):
+    if all(c in UPPERCASE for c in token):
         return token
-    elif any(c in set(string.punctuation) for c in token):
+    elif any(c in PUNCTUATION for c in token):
         return token.lower()
 
     return spell(token).lower()
 
 
-def markov(bot, update, bot_globals, seed=None):
-    """generates sentences using a markov chain"""
-    def no_flood(u):
-        bot_globals['last_commands'][u] = time.time() - bot_globals['MESSAGE_TIMEOUT'] * 2
-
-    message = update.message
-    message_user = message.from_user.username if message.from_user.username is not None else message.from_user.name
-
-    # joins together punctuation at ends of words and auto-completes parenthesis: ['"', 'test', '.'] -> '"test."'
-    # tries its best
-    snap = (('[', '{', '(', '*', "'", '"'), (']', '}', ')', '*', "'", '"'))
-    right = set('!.?~:;,%')
-    left = set()
-
-    def joiner(tokens):
-        snaps = [[], []]
-        output = tokens.copy()
-        for i, t in enumerate(tokens):
-            if t in set(snap[0]) or t in left:
-                if i < len(tokens) - 1:
-                    if t not in left:
-                        snaps[0] += [t]
-                    ind = i + 1
-                    while not output[ind]:
-                        ind += 1
-                    output[ind] = t + tokens[i + 1]
-                    output[i] = ''
-
-            if t in set(snap[1]) or t in right:
-                if i > 0:
-                    if t not in right:
-                        snaps[1] += [t]
-                    ind = i - 1
-                    while not output[ind]:
-                        ind -= 1
-                    output[ind] += t
-                    output[i] = ''
-
-        output = (t for t in output if t != '')
-
-        for c in snaps[0]:
-            completion = snap[1][snap[0].index(c)]
-            if completion in snaps[1]:
-                snaps[0].remove(c)
-                snaps[1].remove(completion)
-
-        snaps[0] = [snap[1][snap[0].index(s)] for s in snaps[0]]
-        snaps[1] = [snap[0][snap[1].index(s)] for s in snaps[1]]
-
-        return ''.join(snaps[1]) + ' '.join(output).strip() + ''.join(snaps[0])
-
-    def capitals(s):
-        if len(s) > 1:
-            return s[0].upper() + s[1:]
-        else:
-            return s.upper()
+# joins together punctuation at ends of words and auto-completes parenthesis: ['"', 'test', '.'] -> '"test."'
+# tries its best
+SNAP = (('[', '{', '(', '*', "'", '"'), (']', '}', ')', '*', "'", '"'))
+RIGHT = set('!.?~:;,%')
+LEFT = set()
+
+
+def joiner(tokens):
+    snaps = [[], []]
+    output = tokens.copy()
+    for i, t in enumerate(tokens):
+        if t in set(SNAP[0]) or t in LEFT:
+            if i < len(tokens) - 1:
+                if t not in LEFT:
+                    snaps[0] += [t]
+                ind = i + 1
+                while not output[ind]:
+                    ind += 1
+                output[ind] = t + tokens[i + 1]
+                output[i] = ''
+
+        if t in set(SNAP[1]) or t in RIGHT:
+            if i > 0:
+                if t not in RIGHT:
+                    snaps[1] += [t]
+                ind = i - 1
+                while not output[ind]:
+                    ind -= 1
+                output[ind] += t
+                output[i] = ''
+
+    output = (t for t in output if t != '')
+
+    for c in snaps[0]:
+        completion = SNAP[1][SNAP[0].index(c)]
+        if completion in snaps[1]:
+            snaps[0].remove(c)
+            snaps[1].remove(completion)
+
+    snaps[0] = [SNAP[1][SNAP[0].index(s)] for s in snaps[0]]
+    snaps[1] = [SNAP[0][SNAP[1].index(s)] for s in snaps[1]]
+
+    return ''.join(snaps[1]) + ' '.join(output).strip() + ''.join(snaps[0])
+
+
+def capitals(s):
+    if len(s) > 1:
+        return s[0].upper() + s[1:]
+    else:
+        return s.upper()
 
-    if len(STATES) == 1:
-        update.message.reply_text(text='No markov states! Type something to contribute to /markov!')
-        return
 
-    output = []
+def compose(output):
+    if len(output) == MAX_OUTPUT_STATES:
+        output = output + ['...']
 
-    if seed is None:
-        text = clean(update.message.text)
-    else:
-        no_flood(message_user)
-        text = seed
+    # capitalize sentences
+    reply = ' '.join((capitals(s) for s in tokenize(joiner(output).strip())))
 
-    if text:
-        state = process_token(text.split()[-1])
-        if state not in set(STATES):
-            update.message.reply_text(text='"{}" is not in markov states.'.format(state))
-            return
-        else:
-            state_index = STATES.index(state)
-            output.append(' '.join(text.split()[:-1] + [STATES[state_index]]))
-    else:
-        state_index = 0
+    if not reply[-1] in string.punctuation:
+        reply += '.'
 
-    # generate text until hitting the next absorbing state or exceeding MAX_OUTPUT_STATES
-    while (state_index != 0 or len(output) == 0) and len(output) < MAX_OUTPUT_STATES:
-        branches, probabilities = find(TRANSITIONS.getrow(state_index))[1:]
+    return reply
 
-        # don't post short responses if longer responses are possible
-        if len(branches) > 1 and branches[0] == 0 and len(output) < MIN_OUTPUT_STATES:
-            branches = branches[1:]
-            probabilities = probabilities[1:]
 
-        # normalization of probabilities
-        transition_sum = sum(probabilities)
-        probabilities = tuple(i/transition_sum for i in probabilities)
+def pooled(count):
+    """takes unseeded walks from POOL, refilling it in one batch when it runs low"""
+    global POOL, POOL_SAMPLER
+    sampler = TRANSITIONS.sampler
 
-        # choose branch with weighted random choice
-        state_index = choice(branches, p=probabilities)
+    # compared by identity, versions start over when /reset or load_model replace TRANSITIONS
+    if POOL_SAMPLER is not sampler:
+        POOL, POOL_SAMPLER = [], sampler
 
-        if state_index != 0:
-            output.append(STATES[state_index])
+    if len(POOL) < count:
+        POOL += sampler.walks(max(count, POOL_SIZE), 0, 0, MIN_OUTPUT_STATES, MAX_OUTPUT_STATES)
 
-    if len(output) == MAX_OUTPUT_STATES:
-        output += ['...']
+    walks, POOL = POOL[:count], POOL[count:]
+    return walks
 
-    # capitalize sentences
-    tokenizer = PunktSentenceTokenizer()
-    reply = ' '.join((capitals(s) for s in tokenizer.tokenize(joiner(output).strip())))
 
-    if not reply[-1] in string.punctuation:
-        reply += '.'
+def sentences(count=1, seed=None, best=False):
+    """generates count sentences in one batched pass, or only the longest of count candidates if best is set
+    raises LookupError with a user facing message if generation isn't possible"""
+    state = process_token(seed.split()[-1]) if seed else None
+
+    with LOCK:
+        if len(STATES) == 1:
+            raise LookupError('No markov states! Type something to contribute to /markov!')
+
+        output = []
+
+        if state is not None:
+            if state not in STATES:
+                raise LookupError('"{}" is not in markov states.'.format(state))
+
+            state_index = STATES.index(state)
+            output.append(' '.join(seed.split()[:-1] + [state]))
+        else:
+            state_index = 0
+
+        # generate text until hitting the next absorbing state or exceeding MAX_OUTPUT_STATES
+        # short responses are avoided while longer ones are possible
+        if state_index == 0 and not best:
+            walks = pooled(count)
+        else:
+            walks = TRANSITIONS.sampler.walks(count, state_index, len(output), MIN_OUTPUT_STATES, MAX_OUTPUT_STATES)
+
+        if best:
+            walks = [max(walks, key=len)]
+
+        walks = [output + [STATES[i] for i in w] for w in walks]
+
+    return [compose(w) for w in walks]
+
+
+def markov(bot, update):
+    """generates sentences using a markov chain"""
+    try:
+        reply = sentences(seed=clean(update.message.text))[0]
+    except LookupError as e:
+        update.message.reply_text(text=str(e))
+        return
 
     update.message.reply_text(text=reply, disable_web_page_preview=True)
 
@@ -200,137 +244,106 @@ def relations(bot, update, bot_globals):
 /network: graphs 20 most probable states and their connections **SLOW**
 """
     text = update.message.text
+    with LOCK:
+        transitions, degrees = TRANSITIONS.csr, TRANSITIONS.degrees
+    size = transitions.shape[0]
+
+    if text.startswith(('/ends', '/starts', '/before', '/after')):
+        state = process_token(clean(text)) if text.startswith(('/before', '/after')) else None
+
+        # ids shift when states are deleted, so they're looked up and named under the same lock
+        with LOCK:
+            transitions = TRANSITIONS.csr
+            size = transitions.shape[0]
+
+            if text.startswith('/ends'):
+                data = transitions.getcol(0).T.tocsr()
+            elif text.startswith('/starts'):
+                data = transitions.getrow(0)
+            elif state not in STATES:
+                data = None
+            elif text.startswith('/before'):
+                data = transitions.getcol(STATES.index(state)).T.tocsr()
+            else:
+                data = transitions.getrow(STATES.index(state))
 
-    if text.startswith('/ends'):
-        data = TRANSITIONS.getcol(0).T
-
-    elif text.startswith('/starts'):
-        data = TRANSITIONS.getrow(0)
+            if data is not None:
+                links = data.indices[np.argsort(-data.data, kind='stable')]
+                output = ', '.join('"{}"'.format(STATES[s]) for s in links[:MAX_OUTPUT_STATES])
 
-    elif text.startswith('/before'):
-        state = process_token(clean(text))
-        if state not in set(STATES):
+        if data is None:
             update.message.reply_text(text='"{}" is not in markov states.'.format(state))
             return
-        else:
-            state_index = STATES.index(state)
-
-        data = TRANSITIONS.getcol(state_index).T
 
-    elif text.startswith('/after'):
-        state = process_token(clean(text))
-        if state not in set(STATES):
-            update.message.reply_text(text='"{}" is not in markov states.'.format(state))
-            return
-        else:
-            state_index = STATES.index(state)
-
-        data = TRANSITIONS.getrow(state_index)
+        percent = round((len(links) / size) * 100)
+        update.message.reply_text(text='{}, {}% of states: {{{}}}\n(Displays {} most probable states.)'
+                                  .format(len(links), percent, output, MAX_OUTPUT_STATES),
+                                  disable_web_page_preview=True)
+        return
 
     elif text.startswith('/mean'):
-        mean = len(find(TRANSITIONS)[0])/TRANSITIONS.shape[0]
-        update.message.reply_text(text='Mean number of branches per state: {}'.format(mean))
+        update.message.reply_text(text='Mean number of branches per state: {}'.format(transitions.nnz / size))
         return
 
     elif text.startswith('/deviation'):
-        mean = len(find(TRANSITIONS)[0]) / TRANSITIONS.shape[0]
-        deviation = 0
-
-        for r in range(TRANSITIONS.shape[0]):
-            deviation += (len(find(TRANSITIONS.getrow(r))[0]) - mean)**2
-
-        deviation /= TRANSITIONS.shape[0]
-        deviation = sqrt(deviation)
-
-        update.message.reply_text(text='Standard deviation of branches per state: {}'.format(deviation))
+        update.message.reply_text(text='Standard deviation of branches per state: {}'.format(degrees.std()))
         return
 
     elif text.startswith('/singleton'):
-        singletons = 0
-        stop_singletons = 0
-
-        for r in range(TRANSITIONS.shape[0]):
-            row = find(TRANSITIONS.getrow(r))[1]
-            if len(row) == 1:
-                singletons += 1
-                if row[0] == 0:
-                    stop_singletons += 1
+        singles = np.flatnonzero(degrees == 1)
+        singletons = len(singles)
+        stop_singletons = np.count_nonzero(transitions.indices[transitions.indptr[singles]] == 0)
 
         update.message.reply_text(text='Probability of a state being a singleton: {}\n'
                                        'Probability of a singleton being an end state singleton: {}\n'
                                        'Probability of a state being an end state singleton: {}'
-                                  .format(singletons/TRANSITIONS.shape[0],
-                                          stop_singletons/singletons,
-                                          stop_singletons/TRANSITIONS.shape[0]))
+                                  .format(singletons / size,
+                                          stop_singletons / singletons if singletons else 0,
+                                          stop_singletons / size))
         return
 
     elif text.startswith('/distribution'):
-        distribution = [0]*TRANSITIONS.shape[0]
-
-        for r in range(1, TRANSITIONS.shape[0]):
-            b = len(find(TRANSITIONS.getrow(r))[1])
-            distribution[b] += 1
-
-        distribution_sum = sum(distribution)
+        # branch counts of every state except the absorbing state, trailing zeros trimmed by bincount
+        distribution = np.bincount(degrees[1:])
+        distribution = distribution / distribution.sum()
 
-        last = 0
-        for i, v in enumerate(distribution):
-            if v:
-                last = i
+        def plot(ax):
+            ax.plot(distribution)
+            ax.set_ylabel('probability')
+            ax.set_xlabel('# branches')
 
-        distribution = [v / distribution_sum for v in distribution[:last]]
-
-        plt.figure(0, figsize=None)
-
-        plt.plot(distribution)
-        plt.ylabel('probability')
-        plt.xlabel('# branches')
-        plt.savefig('temp.png')
-        plt.clf()
-
-        update.message.reply_photo(photo=open('temp.png', 'rb'), timeout=bot_globals['IMAGE_SEND_TIMEOUT'])
+        update.message.reply_photo(photo=render.render(plot), timeout=bot_globals['IMAGE_SEND_TIMEOUT'])
         return
 
     elif text.startswith('/network'):
         net = nx.DiGraph()
         count = 20
 
-        p_sorted = sorted(range(TRANSITIONS.shape[0]), key=lambda r: len(find(TRANSITIONS.getcol(r)[0])))[:count]
+        with LOCK:
+            # states with the most incoming transitions, and the edges between them
+            transitions = TRANSITIONS.csr
+            top = np.argsort(-TRANSITIONS.popularity, kind='stable')[:count]
+            edges = transitions[top][:, top].tocoo()
 
-        for r in p_sorted:
-            row = find(TRANSITIONS.getrow(r))
-            for i, c in enumerate(row[1]):
-                if c in p_sorted:
-                    net.add_edge(STATES[r], STATES[c], weight=row[2][i])
+            for r, c, w in zip(edges.row, edges.col, edges.data):
+                net.add_edge(STATES[top[r]], STATES[top[c]], weight=w)
 
         pos = nx.circular_layout(net, scale=2)
 
-        plt.figure(0, figsize=(100, 100))
-
-        nx.draw_networkx_nodes(net, pos, node_size=300)
-        nx.draw_networkx_edges(net, pos)
-        nx.draw_networkx_labels(net, pos, font_size=8)
+        def plot(ax):
+            nx.draw_networkx_nodes(net, pos, node_size=300, ax=ax)
+            nx.draw_networkx_edges(net, pos, ax=ax)
+            nx.draw_networkx_labels(net, pos, font_size=8, ax=ax)
 
-        plt.title("Markov Network")
-        plt.axis('off')
+            ax.set_title("Markov Network")
+            ax.axis('off')
 
-        plt.savefig('network.svg')
-        plt.clf()
-
-        update.message.reply_document(document=open('network.svg', 'rb'), filename='network.svg')
+        update.message.reply_document(document=render.render(plot, format='svg', figsize=(100, 100)),
+                                      filename='network.svg')
         return
 
     else:
         update.message.reply_text(text='Number of markov generator states: {}'.format(len(STATES)))
-        return
-
-    links = (s for s in find(data)[1])
-    sort = sorted(enumerate(links), key=lambda s: data[0, s[0]], reverse=True)
-    percent = round((len(sort) / TRANSITIONS.shape[0]) * 100)
-    output = ' ,'.join('"{}"'.format(STATES[s[1]]) for s in sort[:MAX_OUTPUT_STATES])
-
-    update.message.reply_text(text='{}, {}% of states: {{{}}}\n(Displays {} most probable states.)'
-                              .format(len(sort), percent, output, MAX_OUTPUT_STATES), disable_web_page_preview=True)
 
 
 handlers.append([CommandHandler(['ends', 'starts', 'after', 'before', 'mean', 'deviation', 'states', 'singleton',
@@ -350,44 +363,29 @@ def convergence(bot, update):
         return
 
     state = process_token(expr[0])
-    if state not in set(STATES):
+    with LOCK:
+        # the id has to match the transitions it indexes
+        state_index = STATES.get(state)
+        transitions = TRANSITIONS.csr
+
+    if state_index is None:
         update.message.reply_text(text='"{}" is not in markov states.'.format(state))
         return
-    else:
-        state_index = STATES.index(state)
 
     if len(expr) > 1 and expr[1].isnumeric() and int(expr[1]) < 10:
         steps = int(expr[1])
     else:
         steps = 10
 
-    # create and populate boolean translation matrix
-    shape = TRANSITIONS.shape
-    transitions = lil_matrix(shape, dtype=bool)
-
-    x, y = find(TRANSITIONS)[:2]
-    for i, v in enumerate(x):
-        transitions[v, y[i]] = True
-    transitions = transitions.asformat('csr')
+    converge, diverge, branches = reach(transitions.indptr, transitions.indices, state_index, steps)
 
     if update.message.text.startswith('/converge'):
-        transitions **= steps
-        converge = len(find(transitions.getrow(state_index))[1])
-
         update.message.reply_text(text='State "{}" converges to {} possible final state{} after {} step{}.'
                                   .format(state, converge, add_s(converge), steps, add_s(steps)))
+    elif diverge >= 0:
+        update.message.reply_text(text='State "{}" diverges at {} step{} where it has {} possible branches.'
+                                  .format(state, diverge, add_s(diverge), branches))
     else:
-        copy = transitions.copy()
-        for s in range(steps + 1):
-            branches = find(transitions.getrow(state_index))[1]
-            if len(branches) > 1:
-                update.message.reply_text(text='State "{}" diverges at {} step{} where it has {} possible branches.'
-                                          .format(state, s, add_s(s), len(branches)))
-                return
-
-            if s != steps:
-                transitions *= copy
-
         update.message.reply_text(text="""State "{}" doesn't diverge within {} step{}."""
                                   .format(state, steps, add_s(steps)))
 
@@ -395,10 +393,32 @@ def convergence(bot, update):
 handlers.append([CommandHandler(['converge', 'diverge'], convergence), {'action': Ca.TYPING, 'mods': True}])
 
 
+def reachability_report(bot, update):
+    """<steps>: convergence and divergence of every state, computed in parallel"""
+    expr = clean(update.message.text)
+    steps = int(expr) if expr.isnumeric() and int(expr) < 10 else 10
+
+    with LOCK:
+        transitions = TRANSITIONS.csr
+
+    report = reachability(transitions, steps, workers=REACH_WORKERS)
+    converge, diverge = report[:, 0], report[:, 1]
+    top = int(np.argmax(converge))
+    stable = np.count_nonzero(diverge < 0)
+
+    update.message.reply_text(text='Reachability of {} states after {} step{}:\n'
+                                   'Mean converging states: {:.2f}\n'
+                                   'Most converging state: "{}" ({})\n'
+                                   "States that don't diverge: {} ({}%)"
+                              .format(len(report), steps, add_s(steps), converge.mean(), STATES[top], converge[top],
+                                      stable, round(stable / len(report) * 100)))
+
+
+handlers.append([CommandHandler('reachability', reachability_report), {'action': Ca.TYPING, 'mods': True}])
+
+
 def merge(bot, update):
     """<state> <state>: merge first state into second"""
-    global TRANSITIONS, STATES
-
     expr = clean(update.message.text)
     states = expr.split()
 
@@ -406,25 +426,17 @@ def merge(bot, update):
         update.message.reply_text(text='Proper syntax is /merge <state> <state>')
         return
 
-    if any(s not in STATES for s in states):
-        update.message.reply_text(text='One or both input states not found in markov states.')
+    if states[0] == states[1]:
+        update.message.reply_text(text='Cannot merge a state into itself.')
         return
 
-    ind = STATES.index(states[0])
-    del STATES[ind]
-
-    keep = [c for c in range(TRANSITIONS.shape[0]) if c != ind]
-
-    row = TRANSITIONS.getrow(ind)[:, keep]
-    col = TRANSITIONS.getcol(ind)[keep, :]
-    loop = TRANSITIONS[ind, ind]
-
-    TRANSITIONS = TRANSITIONS[keep, :][:, keep]
+    # checked under the same lock, a /delete in another chat could remove a state in between
+    with LOCK:
+        if any(s not in STATES for s in states):
+            update.message.reply_text(text='One or both input states not found in markov states.')
+            return
 
-    ind = STATES.index(states[1])
-    TRANSITIONS[ind, :] += row
-    TRANSITIONS[:, ind] += col
-    TRANSITIONS[ind, ind] += loop
+        TRANSITIONS.merge(*STATES.merge(*states))
 
     update.message.reply_text(text='Merged state "{}" into state "{}".'.format(*states))
 
@@ -434,19 +446,15 @@ handlers.append([CommandHandler('merge', merge), {'action': Ca.TYPING, 'mods': T
 
 def delete(bot, update):
     """delete a state"""
-    global TRANSITIONS, STATES
-
     expr = clean(update.message.text)
     state = expr.split()[0]
 
-    if state not in STATES:
-        update.message.reply_text(text='Input state not found in markov states.')
-        return
+    with LOCK:
+        if state not in STATES:
+            update.message.reply_text(text='Input state not found in markov states.')
+            return
 
-    ind = STATES.index(state)
-    del STATES[ind]
-    keep = [c for c in range(TRANSITIONS.shape[0]) if c != ind]
-    TRANSITIONS = TRANSITIONS[keep, :][:, keep]
+        TRANSITIONS.delete(STATES.delete(state))
 
     update.message.reply_text(text='Deleted {}.'.format(state))
 
@@ -482,8 +490,12 @@ def rename(bot, update):
         update.message.reply_text(text='State not found in markov states.')
         return
 
-    ind = STATES.index(states[0])
-    STATES[ind] = states[1]
+    try:
+        with LOCK:
+            STATES.rename(*states)
+    except ValueError:
+        update.message.reply_text(text='State "{}" already exists, use /merge instead.'.format(states[1]))
+        return
 
     update.message.reply_text(text='Renamed "{}" to "{}".'.format(*states))
 
@@ -495,102 +507,207 @@ def reset(bot, update):
     """reset markov states"""
     global STATES, TRANSITIONS
     # initiate STATES and TRANSITIONS with one member (absorbing state)
-    STATES = [' ']
-    TRANSITIONS = lil_matrix((1, 1), dtype=int)
-    pickle.dump([STATES, TRANSITIONS], open(MARKOV_PATH, 'wb+'))
-    db_push(MARKOV_PATH)
+    with LOCK:
+        STATES = Vocabulary()
+        TRANSITIONS = Transitions()
+    snapshot()
     update.message.reply_text(text='Reset markov states.')
 
 
 handlers.append([CommandHandler('reset', reset), {'action': Ca.TYPING, 'mods': True}])
 
 
-def accumulator(bot, update, insert=None):
-    """markov state accumulator"""
-    global STATES, TRANSITIONS
+def token_cache(bot, update):
+    """displays token normalization cache stats"""
+    info = process_token.cache_info()
+    lookups = info.hits + info.misses
+    rate = round(info.hits / lookups * 100, 2) if lookups else 0
 
-    # splits off punctuation at ends of tokens: 'test.' -> ['test', '.']
-    def splitter(text):
-        tokens = []
-        for t in text.split():
-            has_emojis = any(c in emoji.EMOJI_UNICODE for c in t)
-            non_ascii = any(c not in set(string.ascii_letters + string.punctuation) for c in t)
-            no_split = has_emojis or non_ascii
+    update.message.reply_text(text='Token cache: {} hits, {} misses ({}% hit rate)\n{}/{} tokens cached.'
+                              .format(info.hits, info.misses, rate, info.currsize, info.maxsize))
 
-            start = t[0] in set(string.punctuation) - {';', ':'} and len(t) > 1 and not no_split
-            end = t[-1] in set(string.punctuation) and len(t) > 1 and not no_split
 
-            if start and end:
-                tokens.append(t[0])
-                tokens.append(process_token(t.lstrip(t[0]).rstrip(t[-1])))
-                tokens.append(t[-1])
+handlers.append([CommandHandler('token_cache', token_cache), {'action': Ca.TYPING, 'mods': True}])
 
-            elif start:
-                tokens.append(t[0])
-                tokens.append(process_token(t.lstrip(t[0])))
 
-            elif end:
-                tokens.append(process_token(t.rstrip(t[-1])))
-                tokens.append(t[-1])
+# splits off punctuation at ends of tokens: 'test.' -> ['test', '.']
+def splitter(text):
+    tokens = []
+    for t in text.split():
+        has_emojis = any(c in emoji.EMOJI_UNICODE for c in t)
+        non_ascii = any(c not in ASCII for c in t)
+        no_split = has_emojis or non_ascii
 
-            elif has_emojis:
-                tokens.append(t)
+        start = t[0] in PUNCTUATION - {';', ':'} and len(t) > 1 and not no_split
+        end = t[-1] in PUNCTUATION and len(t) > 1 and not no_split
 
-            elif non_ascii:
-                tokens.append(t.lower())
+        if start and end:
+            tokens.append(t[0])
+            tokens.append(process_token(t.lstrip(t[0]).rstrip(t[-1])))
+            tokens.append(t[-1])
 
-            else:
-                tokens.append(process_token(t))
+        elif start:
+            tokens.append(t[0])
+            tokens.append(process_token(t.lstrip(t[0])))
+
+        elif end:
+            tokens.append(process_token(t.rstrip(t[-1])))
+            tokens.append(t[-1])
+
+        elif has_emojis:
+            tokens.append(t)
+
+        elif non_ascii:
+            tokens.append(t.lower())
+
+        else:
+            tokens.append(process_token(t))
 
-        return tokens
+    return tokens
 
-    text = insert if insert else update.message.text
+
+def ingest(texts, insert=False):
+    """tokenizes texts and applies their transition counts in one locked update"""
+    sentences = [splitter(s) for text in texts for s in tokenize(re_name(re_url(text)))]
+    counts = Counter()
+
+    with LOCK:
+        for tokens in sentences:
+            # add new states
+            ids = STATES.extend(tokens)
+
+            if not insert and ids:
+                # absorbing state at start and end of sentence
+                counts.update(zip([0] + ids, ids + [0]))
+
+        # grow transition matrix accordingly
+        TRANSITIONS.resize(len(STATES))
+        TRANSITIONS.update(counts)
+
+
+def ingest_worker(logger):
+    while True:
+        batch = [INGEST.get()]
+        while len(batch) < INGEST_BATCH_SIZE:
+            try:
+                batch.append(INGEST.get_nowait())
+            except Empty:
+                break
+
+        try:
+            ingest([text for text, _ in batch])
+        except Exception as e:
+            logger.warning('markov ingestion of {} messages failed: {}'.format(len(batch), e))
+
+        INGEST_STATS['processed'] += len(batch)
+        INGEST_STATS['lag'] = time.time() - batch[0][1]
+
+
+def accumulator(bot, update, insert=None):
+    """markov state accumulator"""
+    if insert:
+        ingest([insert], insert=True)
+        return
+
+    text = update.message.text
 
     if len(text) > MAX_INPUT_SIZE:
         return
 
-    sentence_tokenizer = PunktSentenceTokenizer()
-    for s in sentence_tokenizer.tokenize(re_name(re_url(text))):
-        tokens = splitter(s)
+    # past half capacity only a shrinking random sample of messages is kept
+    load = INGEST.qsize() / INGEST_QUEUE_SIZE
+    if load > .5 and random() < (load - .5) * 2:
+        INGEST_STATS['dropped'] += 1
+        return
 
-        # add new states
-        STATES += list(set(tokens) - set(STATES))
+    try:
+        INGEST.put_nowait((text, time.time()))
+    except Full:
+        INGEST_STATS['dropped'] += 1
 
-        # scale transition matrix accordingly
-        if len(STATES) > TRANSITIONS.shape[0]:
-            difference = len(STATES) - TRANSITIONS.shape[0]
 
-            v_pad = lil_matrix((difference, TRANSITIONS.shape[0]), dtype=int)
-            h_pad = lil_matrix((len(STATES), difference), dtype=int)
+handlers.append([MessageHandler(callback=accumulator, filters=(Filters.text & (~Filters.command))), None])
 
-            TRANSITIONS = vstack([TRANSITIONS, v_pad])
-            TRANSITIONS = hstack([TRANSITIONS, h_pad])
 
-            TRANSITIONS = lil_matrix(TRANSITIONS)
+def ingest_info(bot, update):
+    """displays markov ingestion queue stats"""
+    update.message.reply_text(text='Ingest queue: {}/{} messages\nLag: {:.3f} seconds\nProcessed: {}\nDropped: {}'
+                              .format(INGEST.qsize(), INGEST_QUEUE_SIZE, INGEST_STATS['lag'],
+                                      INGEST_STATS['processed'], INGEST_STATS['dropped']))
 
-        # increment transition matrix values
-        if not insert:
-            for i, t in enumerate(tokens):
-                state = STATES.index(t)
 
-                # absorbing state at end of sentence
-                next_state = STATES.index(tokens[i+1]) if i < len(tokens) - 1 else 0
+handlers.append([CommandHandler('ingest', ingest_info), {'action': Ca.TYPING, 'mods': True}])
 
-                # absorbing state at start of sentence
-                if i == 0:
-                    TRANSITIONS[0, state] += 1
 
-                # transition state
-                TRANSITIONS[state, next_state] += 1
+def snapshot():
+    """pushes the full model and starts a new, empty delta log"""
+    global SERIAL, DELTAS
 
+    with LOCK:
+        states, transitions = list(STATES), TRANSITIONS.csr
+        STATES.persisted()
+        TRANSITIONS.persisted()
 
-handlers.append([MessageHandler(callback=accumulator, filters=(Filters.text & (~Filters.command))), None])
+    SERIAL = chain.save(MARKOV_PATH, states, transitions)
+    db_push(MARKOV_PATH)
+
+    open(DELTA_PATH, 'wb').close()
+    db_push(DELTA_PATH)
+    DELTAS = 0
 
 
 def flush(bot, job):
-    pickle.dump([STATES, TRANSITIONS], open(MARKOV_PATH, 'wb+'))
-    db_push(MARKOV_PATH)
+    global DELTAS
+
+    with LOCK:
+        if not (STATES.dirty or TRANSITIONS.dirty):
+            return
+
+        # merges, deletes and renames shift ids, only a snapshot can record them
+        full = STATES.restructured or TRANSITIONS.restructured or DELTAS >= SNAPSHOT_INTERVAL
+
+        if not full:
+            base, tokens = STATES.additions()
+            pairs, counts = TRANSITIONS.journal()
+            STATES.persisted()
+
+    if full:
+        snapshot()
+    else:
+        chain.append_delta(DELTA_PATH, SERIAL, base, tokens, pairs, counts)
+        db_push(DELTA_PATH)
+        DELTAS += 1
+
+
+def tokenize(text):
+    global TOKENIZER
+    if TOKENIZER is None:
+        TOKENIZER = punkt.PunktSentenceTokenizer()
+    return TOKENIZER.tokenize(text)
+
+
+def load_model(pulled):
+    global STATES, TRANSITIONS, SERIAL, DELTAS
+    if not pulled.get(MARKOV_PATH):
+        try:
+            db_pull(LEGACY_PATH)
+            chain.migrate(LEGACY_PATH, MARKOV_PATH)
+        except FileNotFoundError:
+            # no model anywhere yet, start from an empty one
+            chain.save(MARKOV_PATH, Vocabulary(), Transitions().csr)
+        db_push(MARKOV_PATH)
+
+    if not pulled.get(DELTA_PATH):
+        open(DELTA_PATH, 'wb').close()
+
+    # memory-mapped, so startup doesn't read the whole model and processes share its pages
+    with LOCK:
+        STATES, TRANSITIONS = chain.load(MARKOV_PATH)
+        SERIAL = chain.snapshot_serial(MARKOV_PATH)
+        DELTAS = chain.replay(DELTA_PATH, SERIAL, STATES, TRANSITIONS)
 
 
 def init(bot_globals):
+    load_model(bot_globals['STATE'])
     bot_globals['jobs'].run_repeating(flush, interval=bot_globals['FLUSH_INTERVAL'])
+    Thread(target=ingest_worker, args=(bot_globals['logger'],), name='markov ingest', daemon=True).start()
@@ -6,6 +6,11 @@ from telegram.ext import CommandHandler
 # Load order, higher loads later. For preventing plugin conflicts. Removing this defaults load order to 0.
 ORDER = -1
 
+# Files to pull from dropbox at startup, fetched concurrently with every other plugin's. Load them in init,
+# bot_globals['STATE'][path] is False if the file didn't exist. Heavy modules can be imported with
+# helpers.lazy_import so they don't slow down startup.
+STATE_FILES = []
+
 handlers = []
 
 
@@ -24,7 +29,10 @@ def command(bot, update):
 # name <bool|str>: If True, checks for bot's @name proceeding command. Defaults to False.
 # -> If value is 'ALLOW_UNNAMED' will only block commands with incorrect bot @names proceeding them.
 # mods <bool>: Only allow bot moderators to use command. Defaults to False
-# flood <bool>: Check flood detector. Defaults to True.
+# flood <bool|str>: Check flood detector. Defaults to True.
+# -> A string names a command class, e.g. 'heavy', whose bucket is charged as well as the default one.
+# -> bot_globals['FLOOD'].refund(user, chat_id) stops a command counting, .exempt(user, seconds) stops limiting a user.
+# -> bot_globals['no_flood'](update) refunds a command run by another command that already went through flood control.
 # admins <bool>: Only allow chat administrators to execute this command. Defaults to False.
 # nsfw <bool>: Only executes in chats not marked SFW. Defaults to False.
 # action <ChatAction>: Action to send to chat while processing command. Defaults to None.
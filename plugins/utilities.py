@@ -29,20 +29,17 @@ def list_plugins(bot, update, bot_globals):
     chat = message.chat
     message_user = user.username if user.username is not None else user.name
 
-    if chat.type == 'private':
-        admins_list = [message_user]
-    else:
-        admins_list = [x.user.username for x in bot.getChatAdministrators(chat_id=message.chat_id,
-                                                                          message_id=message.message_id)]
+    def admin():
+        if is_mod(message_user) or chat.type == 'private':
+            return True
+        return message_user in bot_globals['get_admins'](bot, message.chat_id)
 
     def scope(modifiers):
         if modifiers:
             if 'mods' in modifiers.keys() and modifiers['mods'] and not is_mod(message_user):
                 return False
 
-            admin = message_user in admins_list or is_mod(message_user)
-
-            if 'admins' in modifiers.keys() and modifiers['admins'] and not admin:
+            if 'admins' in modifiers.keys() and modifiers['admins'] and not admin():
                 return False
 
         return True
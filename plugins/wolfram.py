@@ -7,7 +7,7 @@ import xml.etree.ElementTree as Xml
 import requests
 from PIL import Image, ImageOps
 from telegram import ChatAction as Ca
-from telegram import InputMediaPhoto, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram import InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.error import TelegramError
 from telegram.ext import CommandHandler, CallbackQueryHandler
 
@@ -70,7 +70,7 @@ def wolfram(bot, update, bot_globals):
         message.reply_text(text=err + 'Empty query.')
 
 
-handlers.append([CommandHandler("wolfram", wolfram), {'action': Ca.TYPING}])
+handlers.append([CommandHandler("wolfram", wolfram), {'action': Ca.TYPING, 'flood': 'heavy'}])
 
 
 def wolfram_callback(bot, update, bot_globals):
@@ -87,9 +87,10 @@ def wolfram_callback(bot, update, bot_globals):
             if img.size[0] < minimum or img.size[1] < minimum:  # Hacky way to make sure any image sends.
                 pad = sorted([minimum - img.size[0], minimum - img.size[1]])
                 img = ImageOps.expand(img, border=pad[1] // 2, fill=255)
-            fn = 'temp{}.png'.format(idx)
-            img.save(fn, format='PNG')
-            output.append(InputMediaPhoto(caption=caption, media=fn))
+            photo = io.BytesIO()
+            img.save(photo, format='PNG')
+            photo.seek(0)
+            output.append((caption, photo))
         return output
 
     query = update.callback_query
@@ -105,14 +106,14 @@ def wolfram_callback(bot, update, bot_globals):
 
     if message.chat.type == 'private':
         images = album(WOLFRAM_RESULTS[name][idx])
-        for i in images:
-            bot.send_photo(caption=i.caption, photo=open(i.media, 'rb'), chat_id=message.chat.id,
+        for caption, photo in images:
+            bot.send_photo(caption=caption, photo=photo, chat_id=message.chat.id,
                            timeout=bot_globals['IMAGE_SEND_TIMEOUT'])
 
     elif query.from_user.id == message.reply_to_message.from_user.id:
         images = album(WOLFRAM_RESULTS[name][idx])
-        for i in images:
-            bot.send_photo(caption=i.caption, photo=open(i.media, 'rb'), chat_id=message.chat.id,
+        for caption, photo in images:
+            bot.send_photo(caption=caption, photo=photo, chat_id=message.chat.id,
                            reply_to_message_id=message.reply_to_message.message_id,
                            timeout=bot_globals['IMAGE_SEND_TIMEOUT'])
 
@@ -0,0 +1,79 @@
+from threading import Lock
+from time import time
+
+
+class RateLimiter:
+    """token buckets per (user, chat), plus one per command class for commands that cost more"""
+
+    def __init__(self):
+        self.classes = {'default': (1, 20)}  # command class -> (burst, seconds to earn a token back)
+        self.stats = {'allowed': 0, 'limited': 0, 'evicted': 0}
+        self._buckets = {}  # (user, chat, class) -> (tokens, time of last take)
+        self._exempt = {}  # user -> expiry time, None for never
+        self._lock = Lock()
+
+    def define(self, cls, burst, period):
+        with self._lock:
+            self.classes[cls] = (burst, period)
+
+    def _level(self, key, now):
+        burst, period = self.classes[key[2]]
+        tokens, then = self._buckets.get(key, (burst, now))
+        return min(burst, tokens + (now - then) / period)
+
+    def _keys(self, user, chat, cls):
+        return [(user, chat, 'default')] + ([(user, chat, cls)] if cls != 'default' and cls in self.classes else [])
+
+    def take(self, user, chat, cls='default'):
+        """spends a token from each of the user's buckets, returns 0 or the seconds until they could"""
+        now = time()
+        with self._lock:
+            expiry = self._exempt.get(user, 0)
+            if expiry is None or expiry > now:
+                self.stats['allowed'] += 1
+                return 0
+
+            keys = self._keys(user, chat, cls)
+            levels = [self._level(k, now) for k in keys]
+            wait = max((1 - level) * self.classes[k[2]][1] for k, level in zip(keys, levels))
+
+            if wait > 0:
+                self.stats['limited'] += 1
+                return wait
+
+            for k, level in zip(keys, levels):
+                self._buckets[k] = (level - 1, now)
+            self.stats['allowed'] += 1
+            return 0
+
+    def refund(self, user, chat, cls='default'):
+        """gives back what take spent, for commands that shouldn't count towards the limit"""
+        now = time()
+        with self._lock:
+            for k in self._keys(user, chat, cls):
+                if k in self._buckets:
+                    self._buckets[k] = (min(self.classes[k[2]][0], self._level(k, now) + 1), now)
+
+    def exempt(self, user, seconds=None):
+        """stops limiting user, for seconds or until unexempt"""
+        with self._lock:
+            self._exempt[user] = None if seconds is None else time() + seconds
+
+    def unexempt(self, user):
+        with self._lock:
+            self._exempt.pop(user, None)
+
+    def evict(self):
+        """drops full buckets and expired exemptions, a full bucket is the same as none"""
+        now = time()
+        with self._lock:
+            full = [k for k in self._buckets if self._level(k, now) >= self.classes[k[2]][0]]
+            for k in full:
+                del self._buckets[k]
+            for user in [u for u, e in self._exempt.items() if e is not None and e <= now]:
+                del self._exempt[user]
+            self.stats['evicted'] += len(full)
+        return len(full)
+
+    def __len__(self):
+        return len(self._buckets)
@@ -0,0 +1,31 @@
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import matplotlib
+
+matplotlib.use('Agg')  # for libraries that still import pyplot themselves, e.g. networkx
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+RENDER_WORKERS = 2  # figures drawn at once, the rest wait their turn
+
+_pool = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix='render')
+
+
+def draw(plot, format='png', **kwargs):
+    """calls plot(axes) on a new figure and returns it encoded, on the calling thread"""
+    # a figure of its own with an Agg canvas, no pyplot state shared with other calls
+    figure = Figure(**kwargs)
+    FigureCanvasAgg(figure)
+    plot(figure.add_subplot(1, 1, 1))
+
+    image = BytesIO()
+    figure.savefig(image, format=format)
+    image.seek(0)
+    return image
+
+
+def render(plot, format='png', **kwargs):
+    """draw on one of the render workers, blocks until the image is ready"""
+    return _pool.submit(draw, plot, format, **kwargs).result()
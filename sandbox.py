@@ -0,0 +1,260 @@
+import ast
+import pickle
+import resource
+from collections import ChainMap, OrderedDict
+from functools import lru_cache
+from multiprocessing import get_context
+from queue import Queue
+from threading import Lock
+
+PLOT_TYPES = {'plot', 'scatter', 'contour', 'hist', 'contourf'}
+PLOT_NAMES = ('PLOT_TYPE', 'PLOT_ARGS', 'PLOT_KWARGS')
+WARMUP_TIMEOUT = 30  # seconds a new worker gets to import asteval, numpy and matplotlib
+# imported once by the forkserver instead of by every worker. workers still run the bot's main file again
+# (python skips preloading __main__), so what it imports is preloaded too and running it only defines things
+PRELOAD = ['sandbox', 'asteval', 'render', 'scipy.special', 'requests', 'telegram.ext']
+NONDETERMINISTIC = {'TIME', 'open', 'random', 'rand', 'randn', 'randint', 'choice', 'shuffle', 'permutation', 'seed'}
+
+
+class EvalError(Exception):
+    pass
+
+
+def _vm_size():
+    with open('/proc/self/statm') as file:
+        return int(file.read().split()[0]) * resource.getpagesize()
+
+
+def _picklable(value):
+    try:
+        pickle.dumps(value)
+        return True
+    except Exception:
+        return False
+
+
+def _evaluate(interp, baseline, render, expr, memory, symbols):
+    """runs expr on a reused interpreter, returns everything evaluate needs to reply"""
+    err = 'Invalid input:\n\n'
+
+    # the user's names and the injected symbols overlay the shared baseline table, assignments land on top
+    interp.symtable = ChainMap({**memory, **symbols}, baseline)
+    interp.error = []
+
+    result = interp(expr)
+    output = {'result': str(result).strip(), 'none': result is None, 'plot': None}
+    table = interp.symtable  # function calls swap in a copy, so this isn't always the ChainMap made above
+
+    if 'PLOT_TYPE' in table and isinstance(table['PLOT_TYPE'], str):
+        plot_args = table['PLOT_ARGS'] if isinstance(table.get('PLOT_ARGS'), tuple) else tuple()
+        plot_kwargs = table['PLOT_KWARGS'] if isinstance(table.get('PLOT_KWARGS'), dict) else dict()
+
+        if table['PLOT_TYPE'] in PLOT_TYPES:
+            try:
+                plot = lambda ax: getattr(ax, table['PLOT_TYPE'])(*plot_args, **plot_kwargs)
+                output['plot'] = render.draw(plot, format='jpeg').getvalue()
+            except Exception as e:
+                del table['PLOT_TYPE']
+                output['result'] = err + 'Error in pyplot: ' + e.__class__.__name__
+        else:
+            del table['PLOT_TYPE']
+            output['result'] = err + 'Unsupported plot type.'
+
+    elif 'PLOT_TYPE' in table:
+        del table['PLOT_TYPE']
+        output['result'] = err + 'Plot type must be a string.'
+
+    output['plotting'] = any(p in table for p in PLOT_NAMES)
+    output['reply'] = bool(table['REPLY'])
+    output['errors'] = sorted(set(e.get_error()[0] for e in interp.error))
+    # only values that can cross the pipe are remembered
+    output['memory'] = {k: v for k, v in table.maps[0].items()
+                        if k not in baseline and k not in symbols and _picklable(v)}
+    return output
+
+
+def _serve(conn, memory_limit):
+    import render
+    from asteval import Interpreter
+    from scipy.special import gamma
+
+    # one interpreter per worker, its default symbol table is built once and never written to
+    interp = Interpreter(max_time=100000)
+    baseline = {**interp.symtable, 'gamma': gamma}
+
+    if memory_limit:
+        # on top of what the imports already mapped, allocations past it raise MemoryError
+        resource.setrlimit(resource.RLIMIT_AS, (_vm_size() + memory_limit, resource.RLIM_INFINITY))
+    conn.send('ready')
+
+    while True:
+        try:
+            expr, memory, symbols = conn.recv()
+        except EOFError:
+            return
+
+        try:
+            output = _evaluate(interp, baseline, render, expr, memory, symbols)
+        except MemoryError:
+            output = EvalError('Memory limit exceeded.')
+        except Exception as e:
+            output = EvalError(e.__class__.__name__)
+        conn.send(output)
+
+
+@lru_cache(maxsize=1)
+def _builtin_names():
+    from asteval import Interpreter
+    return frozenset(Interpreter().symtable) | {'gamma'}
+
+
+@lru_cache(maxsize=1024)
+def reads(expr, injected):
+    """the injected symbols expr reads, None if its result could depend on anything else"""
+    # anything else: nondeterministic functions, or names read before they're assigned that
+    # aren't injected or built in, which would come from the caller's saved variables
+    try:
+        tree = ast.parse(expr)
+    except SyntaxError:
+        return None
+
+    # comprehension variables only exist inside their comprehension, except in its first iterable
+    scoped = set()
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)):
+            targets = {n.id for g in node.generators for n in ast.walk(g.target) if isinstance(n, ast.Name)}
+            outer = set(ast.walk(node.generators[0].iter))
+            scoped.update(n for n in ast.walk(node) if isinstance(n, ast.Name) and n.id in targets and n not in outer)
+
+    read = set()  # nodes that read a name despite storing to it, like x in x += 1
+    after = {}  # assignment targets, stored once the value has been read
+    uses = []  # (line, column, name, whether it's a read)
+    for node in ast.walk(tree):
+        if node in scoped:
+            continue
+        elif isinstance(node, ast.AugAssign) and isinstance(node.target, ast.Name):
+            read.add(node.target)
+        elif isinstance(node, ast.Assign):
+            for target in node.targets:
+                after.update((n, (node.value.end_lineno, node.value.end_col_offset)) for n in ast.walk(target))
+        elif isinstance(node, ast.Name):
+            line, column = after.get(node, (node.lineno, node.col_offset))
+            uses.append((line, column, node.id, node in read or not isinstance(node.ctx, ast.Store)))
+        elif isinstance(node, ast.arg):
+            uses.append((node.lineno, node.col_offset, node.arg, False))
+        elif isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            uses.append((node.lineno, node.col_offset, node.name, False))
+
+    first = {}
+    for _, _, name, load in sorted(uses, key=lambda u: u[:2]):
+        first.setdefault(name, load)
+    free = {name for name, load in first.items() if load}
+
+    if free & NONDETERMINISTIC or free - injected - _builtin_names():
+        return None
+    return frozenset(free & injected)
+
+
+class ResultCache:
+    """LRU of eval outputs keyed by macro name, content and the injected values it reads"""
+
+    def __init__(self, size=256):
+        self.size = size
+        self.stats = {'hits': 0, 'misses': 0}
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            output = self._entries.get(key)
+            if output is None:
+                self.stats['misses'] += 1
+            else:
+                self.stats['hits'] += 1
+                self._entries.move_to_end(key)
+            return output
+
+    def put(self, key, output):
+        with self._lock:
+            self._entries[key] = output
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, name):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == name]:
+                del self._entries[key]
+
+
+class _Worker:
+    def __init__(self, context, memory_limit):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_serve, args=(child, memory_limit), name='eval worker', daemon=True)
+        self.process.start()
+        child.close()
+        self.ready = False
+        self.tasks = 0
+
+    def stop(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class EvalPool:
+    """asteval in pre-warmed worker processes, killed and replaced when they overrun their time or memory"""
+
+    def __init__(self, workers=2, memory_limit=256 * 2 ** 20, max_tasks=100):
+        # workers fork from a single threaded server, forking the bot itself could copy a lock another thread holds
+        self._context = get_context('forkserver')
+        self._context.set_forkserver_preload(PRELOAD)
+        self.memory_limit = memory_limit
+        self.max_tasks = max_tasks  # evaluations before a worker is replaced, bounds leaks
+        self.stats = {'evals': 0, 'timeouts': 0, 'crashes': 0, 'recycled': 0}
+
+        self._idle = Queue()
+        for _ in range(workers):
+            self._idle.put(_Worker(self._context, memory_limit))
+
+    def run(self, expr, memory, symbols, timeout):
+        """evaluates expr on an idle worker, raises EvalError if it couldn't finish"""
+        worker = self._idle.get()
+        output = None
+
+        try:
+            if not worker.ready:
+                worker.ready = worker.conn.poll(WARMUP_TIMEOUT) and worker.conn.recv() == 'ready'
+
+            if worker.ready:
+                worker.conn.send((expr, memory, symbols))
+                if worker.conn.poll(timeout):
+                    output = worker.conn.recv()
+                    worker.tasks += 1
+                else:
+                    self.stats['timeouts'] += 1
+                    output = EvalError('Evaluation timed out.')
+
+        except (EOFError, OSError):
+            pass
+
+        if output is None:
+            self.stats['crashes'] += 1
+            output = EvalError('Evaluator crashed.' if worker.ready else 'Evaluator failed to start.')
+
+        # anything that didn't end in a clean reply leaves the worker in an unknown state
+        if isinstance(output, EvalError) or worker.tasks >= self.max_tasks:
+            worker.stop()
+            worker = _Worker(self._context, self.memory_limit)
+            self.stats['recycled'] += 1
+
+        self._idle.put(worker)
+        self.stats['evals'] += 1
+
+        if isinstance(output, EvalError):
+            raise output
+        return output
+
+    def close(self):
+        while not self._idle.empty():
+            self._idle.get().stop()
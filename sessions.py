@@ -0,0 +1,92 @@
+import pickle
+import zlib
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+
+class SessionStore:
+    """per-user eval variables, kept compressed so their size is known and bounded"""
+
+    def __init__(self, budget=32 * 2 ** 20, user_limit=2 ** 20, ttl=60 * 60):
+        self.budget = budget  # least recently used sessions are evicted past this many bytes
+        self.user_limit = user_limit  # largest compressed session one user may keep
+        self.ttl = ttl  # seconds a session lasts after it was last saved
+        self.size = 0
+        self.stats = {'saved': 0, 'rejected': 0, 'evicted': 0, 'expired': 0}
+        self._entries = OrderedDict()  # user -> (compressed pickle, expiry time), least recently used first
+        self._lock = Lock()
+
+    def get(self, user):
+        with self._lock:
+            entry = self._entries.get(user)
+            if entry is None:
+                return {}
+            if entry[1] <= time():
+                self._drop(user)
+                self.stats['expired'] += 1
+                return {}
+            self._entries.move_to_end(user)
+        return pickle.loads(zlib.decompress(entry[0]))
+
+    def put(self, user, symbols):
+        """saves a user's variables, returns False if they're over user_limit and were dropped instead"""
+        blob = zlib.compress(pickle.dumps(symbols, pickle.HIGHEST_PROTOCOL)) if symbols else None
+
+        with self._lock:
+            self._drop(user)
+            if blob is None:
+                return True
+            if len(blob) > self.user_limit:
+                self.stats['rejected'] += 1
+                return False
+
+            self._entries[user] = (blob, time() + self.ttl)
+            self.size += len(blob)
+            self.stats['saved'] += 1
+
+            while self.size > self.budget:
+                self._drop(next(iter(self._entries)))
+                self.stats['evicted'] += 1
+        return True
+
+    def discard(self, user):
+        with self._lock:
+            self._drop(user)
+
+    def _drop(self, user):
+        entry = self._entries.pop(user, None)
+        if entry:
+            self.size -= len(entry[0])
+
+    def expire(self):
+        now = time()
+        with self._lock:
+            expired = [u for u, (_, expiry) in self._entries.items() if expiry <= now]
+            for user in expired:
+                self._drop(user)
+            self.stats['expired'] += len(expired)
+        return len(expired)
+
+    def dump(self, file):
+        with self._lock:
+            pickle.dump(dict(self._entries), file, pickle.HIGHEST_PROTOCOL)
+
+    def load(self, file):
+        """adds sessions saved by dump, already expired ones are skipped"""
+        now = time()
+        for user, (blob, expiry) in pickle.load(file).items():
+            if expiry > now and len(blob) <= self.user_limit:
+                with self._lock:
+                    self._drop(user)
+                    self._entries[user] = (blob, expiry)
+                    self.size += len(blob)
+        with self._lock:
+            while self.size > self.budget:
+                self._drop(next(iter(self._entries)))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, user):
+        return user in self._entries
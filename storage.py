@@ -0,0 +1,174 @@
+import json
+import logging
+import os
+from hashlib import sha256
+from shutil import copyfile
+from threading import Condition, Lock, Thread
+from time import sleep, time
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_PATH = '.storage.json'  # name -> remote revision and local content hash as of the last sync
+PUSH_DELAY = 2  # seconds pushes wait so repeated pushes of a file become one upload
+RETRY_DELAY = 30
+
+
+def content_hash(path):
+    digest = sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(2 ** 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class DropboxStore:
+    def __init__(self, token):
+        import dropbox
+        from dropbox.exceptions import ApiError
+        from dropbox.files import WriteMode
+
+        self._db = dropbox.Dropbox(token)
+        self._missing = ApiError
+        self._overwrite = WriteMode('overwrite')
+
+    def revision(self, name):
+        """current remote revision of name, None if it doesn't exist"""
+        try:
+            return self._db.files_get_metadata('/' + name).rev
+        except self._missing:
+            return None
+
+    def download(self, name):
+        return self._db.files_download_to_file(name, '/' + name).rev
+
+    def upload(self, name, data):
+        return self._db.files_upload(data, '/' + name, mode=self._overwrite).rev
+
+
+class LocalStore:
+    """keeps 'remote' files in a local directory, for running the bot without dropbox"""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def revision(self, name):
+        path = os.path.join(self.root, name)
+        return content_hash(path) if os.path.exists(path) else None
+
+    def download(self, name):
+        copyfile(os.path.join(self.root, name), name)
+        return content_hash(name)
+
+    def upload(self, name, data):
+        path = os.path.join(self.root, name)
+        with open(path + '.tmp', 'wb') as file:
+            file.write(data)
+        os.replace(path + '.tmp', path)
+        return sha256(data).hexdigest()
+
+
+class Storage:
+    """syncs local state files with a backend, skipping unchanged downloads and uploading in the background"""
+
+    def __init__(self, backend, manifest=MANIFEST_PATH):
+        self.backend = backend
+        self.manifest_path = manifest
+        self.stats = {'pulled': 0, 'pull skipped': 0, 'pushed': 0, 'push skipped': 0, 'push coalesced': 0}
+
+        self._lock = Lock()
+        self._pending = Condition(self._lock)
+        self._queue = {}  # name -> time first queued, uploaded in queue order
+        self._uploading = None
+
+        try:
+            with open(manifest) as file:
+                self._manifest = json.load(file)
+        except (OSError, ValueError):
+            self._manifest = {}
+
+        self._uploader = Thread(target=self._upload_loop, name='storage uploader', daemon=True)
+        self._uploader.start()
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _record(self, name, revision, digest):
+        with self._lock:
+            self._manifest[name] = {'revision': revision, 'hash': digest}
+            with open(self.manifest_path + '.tmp', 'w') as file:
+                json.dump(self._manifest, file)
+            os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+    def pull(self, name):
+        """downloads name unless the local copy already matches the remote revision"""
+        with self._lock:
+            if name in self._queue or name == self._uploading:  # local copy is newer than the remote one
+                return
+            known = self._manifest.get(name)
+
+        revision = self.backend.revision(name)
+        if revision is None:
+            raise FileNotFoundError(name)
+
+        if known and known['revision'] == revision and os.path.exists(name) and content_hash(name) == known['hash']:
+            self._count('pull skipped')
+            return
+
+        revision = self.backend.download(name)
+        self._record(name, revision, content_hash(name))
+        self._count('pulled')
+
+    def push(self, name):
+        """queues name for upload, returns straight away"""
+        with self._lock:
+            if name in self._queue:
+                self.stats['push coalesced'] += 1  # uploaded once, with whatever the file holds by then
+            else:
+                self._queue[name] = time()
+                self._pending.notify_all()
+
+    def flush(self, timeout=None):
+        """waits for queued uploads, returns whether they all finished"""
+        with self._lock:
+            return self._pending.wait_for(lambda: not self._queue and self._uploading is None, timeout)
+
+    def _upload_loop(self):
+        while True:
+            with self._lock:
+                while not self._queue:
+                    self._pending.wait()
+                name, queued = next(iter(self._queue.items()))
+
+            delay = queued + PUSH_DELAY - time()
+            if delay > 0:
+                sleep(delay)
+
+            with self._lock:
+                del self._queue[name]
+                self._uploading = name
+                known = self._manifest.get(name)
+
+            try:
+                with open(name, 'rb') as file:
+                    data = file.read()
+                digest = sha256(data).hexdigest()
+
+                if known and known['hash'] == digest:
+                    self._count('push skipped')
+                else:
+                    self._record(name, self.backend.upload(name, data), digest)
+                    self._count('pushed')
+
+            except Exception as e:
+                logger.error('upload of "{}" failed, retrying in {}s: {}'.format(name, RETRY_DELAY, e))
+                with self._lock:
+                    # back to the front so later pushes still land after it
+                    self._queue.pop(name, None)
+                    self._queue = {name: time(), **self._queue}
+                sleep(RETRY_DELAY)
+
+            with self._lock:
+                self._uploading = None
+                self._pending.notify_all()
@@ -2,43 +2,65 @@ import csv
 import datetime
 import functools
 import inspect
+import json
 import logging
 import os
 import pickle
 import re
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from importlib import import_module
+from queue import Queue
+from threading import Thread, Lock, local
 
+import requests
 import telegram
-from telegram.ext import Updater
+from telegram.ext import Updater, CommandHandler
+from telegram.utils.request import Request
 
-from helpers import is_mod, db_pull
-
-TOKEN_DICT = [l for l in csv.DictReader(open('tokens.csv', 'r'))][0]
-TELEGRAM_TOKEN = TOKEN_DICT['yoshobeta_bot']
+from helpers import is_mod, db_fetch, LAZY_MODULES
+from ratelimit import RateLimiter
 
 SFW_PATH = 'SFW.pkl'
-db_pull(SFW_PATH)
-SFW = pickle.load(open(SFW_PATH, 'rb'))
+SFW = dict()
 
 GLOBALS_PATH = 'GLOBALS.pkl'
-db_pull(GLOBALS_PATH)
-GLOBALS = pickle.load(open(GLOBALS_PATH, 'rb'))
+GLOBALS = dict()
+
+STATE = dict()  # state file -> whether it was pulled from dropbox at startup
+TIMINGS = dict()  # startup phase -> seconds taken
 
 # defaults
 LOGGING_LEVEL = logging.DEBUG
 MESSAGE_TIMEOUT = 60
-FLOOD_TIMEOUT = 20
+FLOOD_TIMEOUT = 20  # seconds to earn back one command
+FLOOD_BURST = 2  # commands a user can send in a row in one chat
+FLOOD_EVICT_INTERVAL = 60 * 10
 FLUSH_INTERVAL = 60 * 10
 IMAGE_SEND_TIMEOUT = 40
+ADMIN_TTL = 60 * 5  # seconds a chat's administrator list is cached
+STATS_INTERVAL = 60 * 5  # seconds between handler stats dumps
+DISPATCH_WORKERS = 8  # threads running handlers, 0 runs them all on the dispatcher thread
 
-bot = telegram.Bot(token=TELEGRAM_TOKEN)
-updater = Updater(token=TELEGRAM_TOKEN)
-jobs = updater.job_queue
-logging.basicConfig(format='%(asctime)s - [%(levelname)s] - %(message)s')
+bot = updater = jobs = None  # made by setup, importing this file mustn't touch telegram
 logger = logging.getLogger(__name__)
 
-last_commands = dict()
+FLOOD = RateLimiter()
+
+ADMINS = dict()  # chat id -> (administrator usernames, expiry time)
+ADMIN_STATS = {'hits': 0, 'misses': 0, 'invalidations': 0}
+ADMIN_LOCK = Lock()
+
+STATS_PATH = 'STATS.json'
+LATENCY_SAMPLES = 1024  # recent calls per handler that latency percentiles are taken from
+STATS = dict()  # handler -> calls, errors, total/outbound seconds and recent latencies
+STATS_LOCK = Lock()
+OUTBOUND = local()  # seconds the current thread's handler has spent in telegram and http calls
+
+SHARDS = []  # one update queue per dispatch worker, each chat always lands on the same one
+DISPATCH_STATS = {'dispatched': 0, 'lag': 0}
 
 PLUGINS = dict()
 
@@ -53,8 +75,159 @@ def load_globals():
                 globals()[k] = GLOBALS[k]
     logger.level = LOGGING_LEVEL
 
+    FLOOD.define('default', FLOOD_BURST, FLOOD_TIMEOUT)
+    FLOOD.define('heavy', 1, FLOOD_TIMEOUT * 3)  # commands that wait on slow outside services
+
+
+def get_admins(bot, chat_id):
+    """usernames of a chat's administrators, cached for ADMIN_TTL seconds"""
+    with ADMIN_LOCK:
+        cached = ADMINS.get(chat_id)
+        if cached and cached[1] > time.time():
+            ADMIN_STATS['hits'] += 1
+            return cached[0]
+        ADMIN_STATS['misses'] += 1
+
+    admins = {x.user.username for x in bot.getChatAdministrators(chat_id=chat_id)}
+    with ADMIN_LOCK:
+        ADMINS[chat_id] = (admins, time.time() + ADMIN_TTL)
+    return admins
+
+
+def invalidate_admins(chat_id=None):
+    """drops a chat's cached administrators, or every chat's if chat_id is None"""
+    with ADMIN_LOCK:
+        if chat_id is None:
+            ADMIN_STATS['invalidations'] += len(ADMINS)
+            ADMINS.clear()
+        elif ADMINS.pop(chat_id, None):
+            ADMIN_STATS['invalidations'] += 1
+
+
+# counts time spent in a library's network calls towards the handler running on the calling thread
+def time_outbound(cls, method, kind):
+    original = getattr(cls, method)
+
+    @functools.wraps(original)
+    def wrap(*args, **kwargs):
+        start = time.time()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            totals = getattr(OUTBOUND, 'totals', None)
+            if totals is not None:
+                totals[kind] += time.time() - start
+
+    setattr(cls, method, wrap)
+
+
+def instrumented(method, name):
+    @functools.wraps(method)
+    def wrap(*args, **kwargs):
+        outer = getattr(OUTBOUND, 'totals', None)
+        OUTBOUND.totals = {'telegram': 0, 'http': 0}
+        failed = False
+        start = time.time()
+        try:
+            return method(*args, **kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = time.time() - start
+            with STATS_LOCK:
+                s = STATS.setdefault(name, {'calls': 0, 'errors': 0, 'seconds': 0, 'telegram': 0, 'http': 0,
+                                            'latency': deque(maxlen=LATENCY_SAMPLES)})
+                s['calls'] += 1
+                s['errors'] += failed
+                s['seconds'] += elapsed
+                s['telegram'] += OUTBOUND.totals['telegram']
+                s['http'] += OUTBOUND.totals['http']
+                s['latency'].append(elapsed)
+            OUTBOUND.totals = outer
+
+    return wrap
 
-load_globals()
+
+def stats_summary():
+    """handler -> calls, errors, latency percentiles and mean outbound time, in milliseconds"""
+    summary = dict()
+    with STATS_LOCK:
+        for name, s in STATS.items():
+            latency = sorted(s['latency'])
+            pick = lambda p: round(latency[min(len(latency) - 1, int(len(latency) * p))] * 1000, 1)
+            summary[name] = {'calls': s['calls'], 'errors': s['errors'], 'total': round(s['seconds'], 3),
+                             'p50': pick(.5), 'p95': pick(.95), 'p99': pick(.99),
+                             'telegram': round(s['telegram'] / s['calls'] * 1000, 1),
+                             'http': round(s['http'] / s['calls'] * 1000, 1)}
+    return summary
+
+
+def dump_stats(bot, job):
+    with open(STATS_PATH + '.tmp', 'w') as file:
+        json.dump({'time': time.time(), 'dispatch': dispatch_summary(), 'handlers': stats_summary()}, file, indent=2)
+    os.replace(STATS_PATH + '.tmp', STATS_PATH)
+
+
+def evict_flood(bot, job):
+    evicted = FLOOD.evict()
+    logger.debug('flood control evicted {} buckets, {} left'.format(evicted, len(FLOOD)))
+
+
+def no_flood(update):
+    """refunds update's sender, for commands run by another command that already went through flood control"""
+    user = update.message.from_user
+    FLOOD.refund(user.username if user.username is not None else user.name, update.message.chat_id)
+
+
+def stats(bot, update):
+    """displays the slowest handlers by total time"""
+    summary = sorted(stats_summary().items(), key=lambda i: i[1]['total'], reverse=True)
+    text = '\n'.join('{}: {calls} calls, {errors} errors\n  p50 {p50} / p95 {p95} / p99 {p99} ms, '
+                      'telegram {telegram} ms, http {http} ms'.format(n, **s) for n, s in summary[:15])
+    header = 'Dispatch: {workers} workers, {queued} queued (deepest {deepest}), last lag {lag}s\n'\
+        .format(**dispatch_summary())
+    header += 'Flood: {} buckets, {limited} commands limited, {evicted} buckets evicted\n\n'\
+        .format(len(FLOOD), **FLOOD.stats)
+    update.message.reply_text(text=header + (text or 'No handlers called yet.'))
+
+
+# updates from one chat always go to the same worker so they're handled in order,
+# while slow commands in one chat no longer hold up every other chat
+def start_dispatch():
+    process = updater.dispatcher.process_update
+
+    def worker(queue):
+        while True:
+            update, queued = queue.get()
+            with STATS_LOCK:
+                DISPATCH_STATS['lag'] = time.time() - queued
+                DISPATCH_STATS['dispatched'] += 1
+            try:
+                process(update)
+            except Exception as e:
+                logger.error('dispatch worker failed on update "{}": {}'.format(update, e))
+
+    def sharded(update):
+        if not isinstance(update, telegram.Update):  # errors put on the update queue are handled in place
+            return process(update)
+
+        chat, user = update.effective_chat, update.effective_user
+        key = chat.id if chat else user.id if user else 0
+        SHARDS[hash(key) % len(SHARDS)].put((update, time.time()))
+
+    for i in range(DISPATCH_WORKERS):
+        SHARDS.append(Queue())
+        Thread(target=worker, args=(SHARDS[-1],), name='dispatch {}'.format(i), daemon=True).start()
+
+    if SHARDS:
+        updater.dispatcher.process_update = sharded
+
+
+def dispatch_summary():
+    depths = [q.qsize() for q in SHARDS]
+    return {'workers': len(SHARDS), 'queued': sum(depths), 'deepest': max(depths, default=0),
+            'dispatched': DISPATCH_STATS['dispatched'], 'lag': round(DISPATCH_STATS['lag'], 3)}
 
 
 # message modifiers decorator
@@ -62,7 +235,7 @@ load_globals()
 # name <bool|str>: If True, checks for bot's @name proceeding command.
 # -> If value is 'ALLOW_UNNAMED' will only block commands with incorrect bot @names proceeding them.
 # mods <bool>: Only allow bot moderators to use command.
-# flood <bool>: Check flood detector.
+# flood <bool|str>: Check flood detector. A string names the command class whose bucket is also charged, e.g. 'heavy'.
 # admins <bool>: Only allow chat administrators to execute this command.
 # nsfw <bool>: Only executes in chats not marked SFW.
 # action <ChatAction>: Action to send to chat while processing command.
@@ -75,7 +248,6 @@ def modifiers(method=None, age=True, name=False, mods=False, flood=True, admins=
 
     @functools.wraps(method)
     def wrap(*args, **kwargs):  # otherwise wrap function and continue
-        global last_commands
         message = args[1].message
         user = message.from_user
         n = re.match('/\w+(@\w+)\s', message.text + ' ')  # matches "/command@bot"
@@ -85,11 +257,9 @@ def modifiers(method=None, age=True, name=False, mods=False, flood=True, admins=
         chat = message.chat
         title = chat.title if chat.username is None else '@' + chat.username
 
-        if chat.type == 'private':
-            admins_list = [message_user]
-        else:
-            admins_list = [x.user.username for x in bot.getChatAdministrators(chat_id=message.chat_id,
-                                                                              message_id=message.message_id)]
+        # only looked up when a check below needs it
+        def admins_list():
+            return {message_user} if chat.type == 'private' else get_admins(bot, message.chat_id)
 
         # check incoming message attributes
         time_check = not age or message_age < MESSAGE_TIMEOUT
@@ -98,22 +268,20 @@ def modifiers(method=None, age=True, name=False, mods=False, flood=True, admins=
                           message_bot == bot.name.lower(),
                           message_bot is None and name == 'ALLOW_UNNAMED'))
         mod_check = not mods or is_mod(message_user)
-        admin_check = (not admins or message_user in admins_list) or is_mod(message_user)
+        admin_check = not admins or is_mod(message_user) or message_user in admins_list()
         nsfw_check = not nsfw or (title in SFW.keys() and not SFW[title])
         if all((time_check, name_check, mod_check, admin_check, nsfw_check)):
             # flood detector
             start = time.time()
-            if flood and not chat.type == 'private':
-                if message_user in last_commands.keys() and not is_mod(message_user):
-                    elapsed = start - last_commands[message_user]
-                    if elapsed < FLOOD_TIMEOUT:
-                        if bot.username in admins_list:
-                            bot.deleteMessage(chat_id=message.chat_id, message_id=message.message_id)
-                            logger.debug("flood detector couldn't delete command")
-
-                        logger.info('message canceled by flood detector: ' + str(elapsed))
-                        return
-                last_commands[message_user] = time.time()
+            if flood and not chat.type == 'private' and not is_mod(message_user):
+                wait = FLOOD.take(message_user, message.chat_id, flood if isinstance(flood, str) else 'default')
+                if wait:
+                    if bot.username in admins_list():
+                        bot.deleteMessage(chat_id=message.chat_id, message_id=message.message_id)
+                        logger.debug("flood detector couldn't delete command")
+
+                    logger.info('message canceled by flood detector, {:.1f}s to wait'.format(wait))
+                    return
 
             if action:
                 args[0].sendChatAction(chat_id=message.chat_id, action=action)
@@ -126,9 +294,64 @@ def modifiers(method=None, age=True, name=False, mods=False, flood=True, admins=
     return wrap
 
 
-def load_plugins():
-    global PLUGINS
+@contextmanager
+def phase(name):
+    start = time.time()
+    yield
+    TIMINGS[name] = time.time() - start
+
+
+# plugins are imported before anything is pulled so their STATE_FILES can be fetched alongside the bot's own
+def import_plugins():
+    for fn in (n for n in os.listdir('plugins') if n.endswith('.py')):
+        plugin = import_module('plugins.' + fn[:len(fn) - 3])
+
+        # check and validate docstring
+        if plugin.__doc__ and plugin.__doc__.startswith('yosho plugin'):
+            tags = plugin.__doc__.split(':')
+            if len(tags) > 1 and len(tags[1]) > 0:
+                PLUGINS[str.strip(tags[1])] = plugin
+            else:
+                logger.error('plugin file "{}" docstring malformed'.format(fn))
+
+
+# pull every state file at once, missing files are left to the plugin that declared them
+def pull_state():
+    files = [SFW_PATH, GLOBALS_PATH]
+    for plugin in PLUGINS.values():
+        files += [f for f in getattr(plugin, 'STATE_FILES', []) if f not in files]
+
+    with ThreadPoolExecutor(max_workers=len(files)) as pool:
+        STATE.update(zip(files, pool.map(db_fetch, files)))
+
+    missing = [f for f, pulled in STATE.items() if not pulled]
+    if missing:
+        logger.warning('state files not found in dropbox: ' + ', '.join(missing))
+
+
+def load_state():
+    global SFW, GLOBALS
+    if STATE[SFW_PATH]:
+        with open(SFW_PATH, 'rb') as file:
+            SFW = pickle.load(file)
+    if STATE[GLOBALS_PATH]:
+        with open(GLOBALS_PATH, 'rb') as file:
+            GLOBALS = pickle.load(file)
+    load_globals()
 
+
+# import lazily loaded modules in the background so the first command that needs them doesn't wait
+def warm_imports():
+    start = time.time()
+    for module in LAZY_MODULES:
+        try:
+            module.load()
+        except ImportError as e:
+            logger.warning('could not import "{}": {}'.format(module._name, e))
+    logger.debug('warmed {} lazy imports in {:.2f}s'.format(len(LAZY_MODULES), time.time() - start))
+
+
+def load_plugins():
     def globals_sender(method):
         @functools.wraps(method)
         def wrapper(*args, **kwargs):
@@ -143,17 +366,6 @@ def load_plugins():
         else:
             return 0
 
-    for fn in (n for n in os.listdir('plugins') if n.endswith('.py')):
-        plugin = import_module('plugins.' + fn[:len(fn) - 3])
-
-        # check and validate docstring
-        if plugin.__doc__ and plugin.__doc__.startswith('yosho plugin'):
-            tags = plugin.__doc__.split(':')
-            if len(tags) > 1 and len(tags[1]) > 0:
-                PLUGINS[str.strip(tags[1])] = plugin
-            else:
-                logger.error('plugin file "{}" docstring malformed'.format(fn))
-
     sorted_plugins = sorted(PLUGINS.keys(), key=order)
 
     for n in sorted_plugins:  # enforce plugin load order
@@ -169,6 +381,7 @@ def load_plugins():
                 if 'bot_globals' in inspect.signature(h.callback).parameters:
                     h.callback = globals_sender(h.callback)
 
+                h.callback = instrumented(h.callback, '{}.{}'.format(n, h.callback.__name__))
                 updater.dispatcher.add_handler(h, group=g)
 
         logger.info('loaded plugin "{}"'.format(n))
@@ -176,21 +389,53 @@ def load_plugins():
     for n in sorted_plugins:  # initialize plugins
         # if init method is present in plugin, execute on load
         if hasattr(PLUGINS[n], 'init') and callable(PLUGINS[n].init):
-            if 'bot_globals' in inspect.signature(PLUGINS[n].init).parameters:
-                PLUGINS[n].init(bot_globals=globals())
-            else:
-                PLUGINS[n].init()
+            with phase('init ' + n):
+                if 'bot_globals' in inspect.signature(PLUGINS[n].init).parameters:
+                    PLUGINS[n].init(bot_globals=globals())
+                else:
+                    PLUGINS[n].init()
 
 
 def error(bot, update, error):
     logger.warning('update "{}" caused error "{}"'.format(update, error))
 
 
-updater.dispatcher.add_error_handler(error)
-
-# HARD-CODED COMMANDS GO HERE, BEFORE PLUGINS LOAD #
-
-
-load_plugins()
-logger.info("bot loaded")
-updater.start_polling()
+def setup():
+    """creates the bot and its updater, registers hard-coded commands"""
+    global bot, updater, jobs
+    token = [l for l in csv.DictReader(open('tokens.csv', 'r'))][0]['yoshobeta_bot']
+    bot = telegram.Bot(token=token)
+    updater = Updater(token=token)
+    jobs = updater.job_queue
+    logging.basicConfig(format='%(asctime)s - [%(levelname)s] - %(message)s')
+
+    time_outbound(Request, 'post', 'telegram')
+    time_outbound(Request, 'retrieve', 'telegram')
+    time_outbound(requests.Session, 'request', 'http')  # e621, wolfram, url checks and dropbox
+
+    updater.dispatcher.add_error_handler(error)
+
+    # HARD-CODED COMMANDS GO HERE, BEFORE PLUGINS LOAD #
+    updater.dispatcher.add_handler(CommandHandler('stats', instrumented(
+        modifiers(stats, mods=True, flood=False, action=telegram.ChatAction.TYPING, level=logging.DEBUG), 'stats')))
+
+
+# worker processes import this file again, only the bot itself runs what's below
+if __name__ == '__main__':
+    setup()
+    startup = time.time()
+    with phase('import plugins'):
+        import_plugins()
+    with phase('pull state'):
+        pull_state()
+    with phase('load globals'):
+        load_state()
+    load_plugins()
+    TIMINGS['total'] = time.time() - startup
+    logger.info('bot loaded: ' + ', '.join('{} {:.2f}s'.format(k, v) for k, v in TIMINGS.items()))
+
+    jobs.run_repeating(dump_stats, interval=STATS_INTERVAL)
+    jobs.run_repeating(evict_flood, interval=FLOOD_EVICT_INTERVAL)
+    start_dispatch()
+    updater.start_polling()
+    Thread(target=warm_imports, name='warm imports', daemon=True).start()